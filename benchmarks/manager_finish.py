@@ -0,0 +1,73 @@
+"""Benchmark ObjectManager.finish with synthetic object graphs.
+
+Usage: python benchmarks/manager_finish.py [count ...]
+
+Every object depends on two earlier ones so that finishing an object
+releases some of the later ones. Objects are finished in order, just as
+the manager would when they are realized.
+"""
+
+import sys
+import time
+import asyncio
+import logging
+
+from cdist import manager
+
+
+class FakeObject(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return '<FakeObject %s>' % self.name
+
+
+class FakeRuntime(object):
+    """Just enough of a Runtime for the ObjectManager's bookkeeping."""
+
+    def __init__(self, dependencies):
+        self.log = logging.getLogger('benchmark')
+        self.loop = asyncio.new_event_loop()
+        self.dependencies = dependencies
+
+    def get_dependencies(self, _object):
+        return self.dependencies[_object.name]
+
+
+def build(count):
+    dependencies = {}
+    objects = []
+    for i in range(count):
+        name = '__bench/%d' % i
+        after = []
+        if i:
+            after = sorted({'__bench/%d' % (i // 2), '__bench/%d' % (i - 1)})
+        dependencies[name] = {'require': [], 'after': after, 'before': [], 'auto': []}
+        objects.append(FakeObject(name))
+    return objects, FakeRuntime(dependencies)
+
+
+def run(count):
+    objects, runtime = build(count)
+    om = manager.ObjectManager(runtime)
+    for _object in objects:
+        om.add(_object)
+    started = time.time()
+    for _object in objects:
+        om.resolve_dependencies(_object)
+    resolved = time.time()
+    for _object in objects:
+        om.finish(_object)
+    finished = time.time()
+    return resolved - started, finished - resolved
+
+
+def main(counts):
+    for count in counts:
+        resolve, finish = run(count)
+        print('%6d objects: resolve %8.3fs  finish %8.3fs' % (count, resolve, finish), flush=True)
+
+
+if __name__ == '__main__':
+    main([int(c) for c in sys.argv[1:]] or [1000, 10000, 50000])
@@ -0,0 +1,68 @@
+"""Benchmark Session.to_dir with synthetic conf dirs.
+
+Usage: python benchmarks/session_setup.py [types ...]
+
+Creates the given number of types, with an explorer and a manifest each,
+spread over three conf dirs and times writing a session for them. The first
+session builds the shared session template, the following ones reuse it.
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from cdist import session
+
+
+RUNS = 5
+
+
+def build(base_path, count):
+    conf_dirs = []
+    for i in range(3):
+        conf_dir = os.path.join(base_path, 'conf-%d' % i)
+        for sub_dir in ('explorer', 'manifest', 'type'):
+            os.makedirs(os.path.join(conf_dir, sub_dir))
+        conf_dirs.append(conf_dir)
+    with open(os.path.join(conf_dirs[0], 'manifest', 'init'), 'w') as fd:
+        fd.write('true\n')
+    for i in range(count):
+        conf_dir = conf_dirs[i % len(conf_dirs)]
+        type_path = os.path.join(conf_dir, 'type', '__bench_%d' % i)
+        os.makedirs(os.path.join(type_path, 'parameter'))
+        with open(os.path.join(type_path, 'parameter', 'optional'), 'w') as fd:
+            fd.write('state\n')
+        with open(os.path.join(conf_dir, 'explorer', 'bench_%d' % i), 'w') as fd:
+            fd.write('true\n')
+        with open(os.path.join(conf_dir, 'manifest', 'bench_%d' % i), 'w') as fd:
+            fd.write('true\n')
+    return conf_dirs
+
+
+def run(base_path, conf_dirs):
+    started = time.time()
+    _session = session.Session()
+    for conf_dir in conf_dirs:
+        _session.add_conf_dir(conf_dir)
+    local_session_dir = tempfile.mkdtemp(prefix='session-', dir=base_path)
+    _session.to_dir(local_session_dir)
+    return time.time() - started
+
+
+def main(counts):
+    for count in counts:
+        base_path = tempfile.mkdtemp(prefix='cdist-benchmark-')
+        os.environ['XDG_CACHE_HOME'] = os.path.join(base_path, 'cache')
+        try:
+            conf_dirs = build(base_path, count)
+            first = run(base_path, conf_dirs)
+            again = min(run(base_path, conf_dirs) for i in range(RUNS))
+        finally:
+            shutil.rmtree(base_path)
+        print('%6d types: first session %8.3fs  following sessions %8.3fs' % (count, first, again), flush=True)
+
+
+if __name__ == '__main__':
+    main([int(c) for c in sys.argv[1:]] or [100, 500, 2000])
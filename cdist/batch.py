@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+#
+# 2015 Steven Armstrong (steven-cdist at armstrong.cc)
+#
+# This file is part of cdist.
+#
+# cdist is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cdist is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cdist. If not, see <http://www.gnu.org/licenses/>.
+#
+#
+
+import asyncio
+import logging
+log = logging.getLogger(__name__)
+
+
+class Batch(object):
+    """Collects the items submitted during one iteration of the event loop
+    and processes them together.
+
+    Subclasses implement `process` which is given the list of items and
+    returns a list of results in the same order. A result which is an
+    exception instance is raised to whoever submitted that item.
+
+    A serial batch processes one batch at a time and collects the items
+    submitted in the meantime into the next one.
+    """
+    serial = False
+
+    def __init__(self, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.pending = []
+        self.handle = None
+        self.running = 0
+
+    def submit(self, item):
+        """Add the given item to the current batch and return a future which
+        is resolved with its result once the batch has been processed.
+        """
+        future = asyncio.Future(loop=self.loop)
+        self.pending.append((item, future))
+        if self.handle is None:
+            self.handle = self.loop.call_soon(self._schedule)
+        return future
+
+    def _schedule(self):
+        self.handle = None
+        if self.serial and self.running:
+            # picked up once the running batch is done
+            return
+        pending, self.pending = self.pending, []
+        self.running += 1
+        asyncio.ensure_future(self._run(pending), loop=self.loop)
+
+    async def _run(self, pending):
+        items = [item for item, future in pending]
+        try:
+            results = await self.process(items)
+        except Exception as e:
+            for item, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for (item, future), result in zip(pending, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+        finally:
+            self.running -= 1
+            if self.pending and self.handle is None:
+                self.handle = self.loop.call_soon(self._schedule)
+
+    async def process(self, items):
+        raise NotImplementedError
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+#
+# 2015 Steven Armstrong (steven-cdist at armstrong.cc)
+#
+# This file is part of cdist.
+#
+# cdist is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cdist is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cdist. If not, see <http://www.gnu.org/licenses/>.
+#
+#
+
+
+import os
+import json
+import logging
+log = logging.getLogger(__name__)
+
+
+def cache_dir():
+    """Return the directory in which cdist keeps data between runs."""
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'cdist')
+
+
+class JsonCache(object):
+    """Base class for caches whose entries are kept in a json file.
+
+    The entries are loaded on first use. A missing or corrupt file starts an
+    empty cache. Files are replaced atomically, so concurrent runs never
+    read a partially written one.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = None
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.path)
+
+    def load(self):
+        if self.entries is None:
+            try:
+                with open(self.path, 'r') as fd:
+                    self.entries = json.load(fd)
+            except (FileNotFoundError, ValueError):
+                self.entries = {}
+        return self.entries
+
+    def write(self, path):
+        """Write the entries to the given path."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '%s.%d' % (path, os.getpid())
+        with open(tmp_path, 'w') as fd:
+            json.dump(self.load(), fd, separators=(',', ':'))
+        os.rename(tmp_path, path)
@@ -1,13 +1,11 @@
 import os
 import sys
 import itertools
+import functools
 import logging
 
-import pkg_resources
-
 import click
 from click.utils import make_str
-from click_plugins import with_plugins
 
 
 def get_profile_path(path):
@@ -53,6 +51,34 @@ def with_cprofile(func):
 
 
 def cdist_command(func):
+    """Turn the given function into the cdist command group.
+
+    The group and its subcommands, which are discovered from entry points,
+    are only set up when the command is run. When run as a type the
+    emulator is run right away without importing any of that.
+    """
+    group = None
+
+    @functools.wraps(func)
+    def command(*args, **kwargs):
+        nonlocal group
+        # Special handling if we are run as the emulator
+        prog_name = make_str(os.path.basename(
+                sys.argv and sys.argv[0] or __file__))
+        if prog_name.startswith('__'):
+            from cdist import emulator_client
+            return emulator_client.main()
+        if group is None:
+            group = _cdist_group(func)
+        return group(*args, **kwargs)
+    return command
+
+
+def _cdist_group(func):
+    # only needed here, expensive to import
+    import pkg_resources
+    from click_plugins import with_plugins
+
     # Discover and merge commands from entry points
     entry_point_names = ['cdist.cli.commands']
     if 'CDIST_INTERNAL' in os.environ:
@@ -61,13 +87,6 @@ def cdist_command(func):
     for entry_point in entry_point_names:
         entry_points += pkg_resources.iter_entry_points(entry_point)
 
-    # Special handling if we are run as the emulator
-    prog_name = make_str(os.path.basename(
-            sys.argv and sys.argv[0] or __file__))
-    if prog_name.startswith('__'):
-        # inject `emulator` subcommand to handle cdist object creation
-        sys.argv = [sys.argv[0]] + ['emulator', prog_name] + sys.argv[1:]
-
     # Add decorators
     func = click.group()(func)
     func = with_plugins(entry_points)(func)
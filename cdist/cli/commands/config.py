@@ -6,12 +6,13 @@ import pprint
 
 import click
 
-from cdist import exceptions
 from cdist import session
 from cdist import runtime
 from cdist import manager
+from cdist import scheduler
+from cdist import explorer_cache
 
-from cdist.cli.utils import comma_delimited_string_to_set
+from cdist.cli.utils import comma_delimited_string_to_set, explorer_ttls
 
 
 def log(msg):
@@ -36,6 +37,8 @@ async def configure_target(_runtime):
     except Exception as e:
         log(str(e))
         raise e
+    finally:
+        await _runtime.cleanup()
 
 
 @click.command(name='config')
@@ -52,12 +55,47 @@ async def configure_target(_runtime):
     default=True, help='Operate on multiple hosts sequentially (default).')
 @click.option('-p', '--parallel', 'operation_mode', flag_value='parallel',
     help='Operate on multiple hosts in parallel.')
+@click.option('-j', '--jobs', type=int,
+    help='Operate on at most this many hosts in parallel. Implies --parallel.')
+@click.option('--persistent-shell', is_flag=True, default=False,
+    help='Run remote commands through a single long lived shell per target.')
+@click.option('--batch-explorers', is_flag=True, default=False,
+    help='Run the type explorers of all objects that are prepared at the same time in one remote shell.')
+@click.option('--batch-code-remote', is_flag=True, default=False,
+    help='Transfer and run the code-remote of all objects that are ready at the same time together.')
+@click.option('--explorer-cache-ttl', type=int,
+    help='Reuse the results of global explorers from previous runs for this many seconds.')
+@click.option('--explorer-ttl', multiple=True, callback=explorer_ttls,
+    help='Reuse the results of the given explorer for this many seconds, e.g. memory=86400 or __package/state=600.')
+@click.option('--invalidate-explorer-cache', is_flag=True, default=False,
+    help='Forget the cached explorer results of the targets.')
+@click.option('--sync-conf', is_flag=True, default=False,
+    help='Keep explorers on the targets between runs and only send what changed.')
+@click.option('--exec-limit', type=int,
+    help='Maximum number of concurrent remote commands per target.')
+@click.option('--copy-limit', type=int,
+    help='Maximum number of concurrent remote copies per target.')
+@click.option('--adaptive-limits', is_flag=True, default=False,
+    help='Adjust the per target limits to what the target can handle.')
+@click.option('--prepare-jobs', type=int,
+    help='Number of objects per target whose explorers and manifest are run at the same time.')
+@click.option('--apply-jobs', type=int,
+    help='Number of objects per target whose code is generated and run at the same time.')
+@click.option('--max-local-processes', type=int,
+    help='Maximum number of local processes over all targets.')
+@click.option('--max-remote-processes', type=int,
+    help='Maximum number of remote-exec and remote-copy processes over all targets.')
 @click.argument('target', nargs=-1)
 @click.pass_context
-def main(ctx, manifest, only_tag, include_tag, exclude_tag, dry_run, operation_mode, target):
+def main(ctx, manifest, only_tag, include_tag, exclude_tag, dry_run, operation_mode, jobs, persistent_shell,
+        batch_explorers, batch_code_remote,
+        explorer_cache_ttl, explorer_ttl, invalidate_explorer_cache, sync_conf, exec_limit, copy_limit, adaptive_limits, prepare_jobs, apply_jobs,
+        max_local_processes, max_remote_processes, target):
     '''Configure the given targets.
 
     A TARGET is expected to be a hostname or url representing the target to work on.
+    The concurrency limits can be overridden per target in the query part of
+    its url, e.g. ssh://example.com?exec-limit=10&copy-limit=5&adaptive=yes&apply-jobs=20
 
     Each of the --*-tag option can be given multiple times. Additionally each
     of the values of these options can be a comma seperated strings.
@@ -78,6 +116,12 @@ def main(ctx, manifest, only_tag, include_tag, exclude_tag, dry_run, operation_m
         ctx.fail('Options \'only-tag\' and \'exclude-tag\' have conflicting values: %s vs %s' % (only_tag, exclude_tag))
     if not include_tag.isdisjoint(exclude_tag):
         ctx.fail('Options \'include-tag\' and \'exclude-tag\' have conflicting values: %s vs %s' % (include_tag, exclude_tag))
+    if jobs is not None:
+        if jobs < 1:
+            ctx.fail('Option \'jobs\' must be at least 1.')
+        operation_mode = 'parallel'
+    elif operation_mode == 'sequential':
+        jobs = 1
 
 
     tags = {
@@ -114,24 +158,52 @@ def main(ctx, manifest, only_tag, include_tag, exclude_tag, dry_run, operation_m
 
     remote_session_dir = _session['remote-session-dir']
 
+    limits = {
+        'exec-limit': exec_limit,
+        'copy-limit': copy_limit,
+        'adaptive': adaptive_limits,
+    }
+
     loop = asyncio.get_event_loop()
 
-    # Create a list of asyncio tasks, one for each runtime.
-    tasks = []
-    for _target in _session.targets:
-        _runtime = runtime.Runtime(_target, local_session_dir, remote_session_dir, tags=tags, loop=loop)
-        task = loop.create_task(configure_target(_runtime))
-        tasks.append(task)
+    budget = scheduler.ProcessBudget(
+        local=max_local_processes,
+        remote=max_remote_processes,
+        loop=loop,
+    )
 
-    # Execute the tasks in parallel using asyncio.
+    # Create a runtime for each target.
+    runtimes = []
+    for _target in _session.targets:
+        cache = None
+        if explorer_cache_ttl or explorer_ttl or invalidate_explorer_cache:
+            cache = explorer_cache.ExplorerCache.for_target(_target, ttl=explorer_cache_ttl, ttls=explorer_ttl)
+            if invalidate_explorer_cache:
+                cache.invalidate()
+        _runtime = runtime.Runtime(_target, local_session_dir, remote_session_dir, tags=tags, loop=loop,
+            persistent_shell=persistent_shell,
+            batch_explorers=batch_explorers, batch_code_remote=batch_code_remote,
+            explorer_cache=cache, sync_conf=sync_conf,
+            prepare_jobs=prepare_jobs, apply_jobs=apply_jobs,
+            limits=limits, budget=budget)
+        runtimes.append(_runtime)
+
+    # Configure the targets, at most `jobs` of them at the same time.
+    pool = scheduler.WorkerPool(jobs=jobs, loop=loop)
     try:
-        results = []
-        if tasks:
-            results = loop.run_until_complete(asyncio.gather(*tasks))
-    except exceptions.CdistError as e:
-        log.error(str(e))
-        raise
-        ctx.exit(1)
+        results = loop.run_until_complete(pool.run(configure_target, runtimes))
     finally:
         loop.close()
 
+    failed = False
+    for result in results:
+        cache = result.item.explorer_cache
+        if cache is not None:
+            log.info('%s: explorer cache: %d hits, %d misses', result.item.target['url'], cache.hits, cache.misses)
+        if result.error:
+            failed = True
+            log.error('%s: failed after %.2fs: %s', result.item.target['url'], result.duration, result.error)
+        else:
+            click.echo('%s: configured in %.2fs' % (result.item.target['url'], result.duration))
+    if failed:
+        ctx.exit(1)
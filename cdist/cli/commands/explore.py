@@ -4,7 +4,6 @@ import tempfile
 import shutil
 import asyncio
 import asyncio.subprocess
-import glob
 import json
 
 import click
@@ -12,8 +11,9 @@ import click
 from cdist import exceptions
 from cdist import session
 from cdist import runtime
+from cdist import explorer_cache
 
-from cdist.cli.utils import comma_delimited_string_to_set
+from cdist.cli.utils import comma_delimited_string_to_set, explorer_ttls
 
 
 
@@ -32,32 +32,25 @@ class LocalRuntime(runtime.Runtime):
         result = await self.local.check_output([explorer], env=env)
         return result.decode('ascii').rstrip()
 
-    async def run_global_explorers(self, explorer_names=None):
-        """Run all global explorers and save their output in the session.
+    async def transfer_global_explorers(self):
+        """Nothing to transfer, the explorers are run where they are.
         """
-        self.log.debug('Running global explorers locally')
-        # execute explorers in parallel
-        tasks = []
-        if not explorer_names:
-            explorer_names = glob.glob1(self.path['local']['explorer'], '*')
-        for name in explorer_names:
-            task = self.loop.create_task(self.run_global_explorer(name))
-            task.name = name
-            tasks.append(task)
-        if tasks:
-            results = await asyncio.gather(*tasks)
-            for index,name in enumerate(explorer_names):
-                self.target['explorer'][name] = results[index]
-            await self.sync_target('explorer')
+        pass
 
 
 @click.command(name='explore')
 @click.option('-e', '--explorer', multiple=True, callback=comma_delimited_string_to_set,
     help='Run the given explorers instead of all of them.')
 @click.option('-j', '--json', 'json_output', is_flag=True, help='Output result as json instead of text.')
+@click.option('--explorer-cache-ttl', type=int,
+    help='Reuse the results of global explorers from previous runs for this many seconds.')
+@click.option('--explorer-ttl', multiple=True, callback=explorer_ttls,
+    help='Reuse the results of the given explorer for this many seconds, e.g. memory=86400 or __package/state=600.')
+@click.option('--invalidate-explorer-cache', is_flag=True, default=False,
+    help='Forget the cached explorer results of the targets.')
 @click.argument('target', nargs=1, default='__local__')
 @click.pass_context
-def main(ctx, explorer, json_output, target):
+def main(ctx, explorer, json_output, explorer_cache_ttl, explorer_ttl, invalidate_explorer_cache, target):
     """Explore the given target.
 
     TARGET is expected to be the hostname of the target to work on.
@@ -87,13 +80,25 @@ def main(ctx, explorer, json_output, target):
 
     loop = asyncio.get_event_loop()
 
+    cache = None
+    if explorer_cache_ttl or explorer_ttl or invalidate_explorer_cache:
+        cache = explorer_cache.ExplorerCache.for_target(_target, ttl=explorer_cache_ttl, ttls=explorer_ttl)
+        if invalidate_explorer_cache:
+            cache.invalidate()
+
+    _runtime = None
     try:
         if target is not '__local__':
-            _runtime = runtime.Runtime(_target, local_session_dir, remote_session_dir, loop=loop)
+            _runtime = runtime.Runtime(_target, local_session_dir, remote_session_dir, loop=loop,
+                explorer_cache=cache)
             loop.run_until_complete(_runtime.initialize())
         else:
-            _runtime = LocalRuntime(_target, local_session_dir, remote_session_dir, loop=loop)
+            _runtime = LocalRuntime(_target, local_session_dir, remote_session_dir, loop=loop,
+                explorer_cache=cache)
         loop.run_until_complete(_runtime.run_global_explorers(explorer_names=explorer))
+        if cache is not None:
+            cache.save()
+            click.echo('explorer cache: {0} hits, {1} misses'.format(cache.hits, cache.misses), err=True)
         if json_output:
             click.echo(json.dumps(_target['explorer']))
         else:
@@ -105,4 +110,6 @@ def main(ctx, explorer, json_output, target):
         raise
         ctx.exit(1)
     finally:
+        if _runtime is not None:
+            loop.run_until_complete(_runtime.cleanup())
         loop.close()
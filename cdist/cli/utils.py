@@ -1,21 +1,20 @@
+import click
 
-class delimited_string_to_set(object):
-    """A click option callback that flattens a list of delimiter seperated
-    strings into one list of options.
+# also used by the type emulator which should not need to import the
+# cdist.cli package
+from cdist.util import (delimited_string_to_set, comma_delimited_string_to_set,
+    space_delimited_string_to_set)
 
-    Usage:
 
-    comma_delimited_string_to_set = delimited_string_to_set(',')
-    option = click.Option(('--name',), callback=comma_delimited_string_to_set)
+def explorer_ttls(ctx, param, value):
+    """A click option callback that turns a list of 'explorer=seconds'
+    strings into a dictionary.
     """
-    def __init__(self, delimiter):
-        self.delimiter = delimiter
-
-    def __call__(self, ctx, param, value):
-        _list = []
-        for v in value:
-            _list.extend(v.split(self.delimiter))
-        return set(_list)
-
-comma_delimited_string_to_set = delimited_string_to_set(',')
-space_delimited_string_to_set = delimited_string_to_set(' ')
+    ttls = {}
+    for v in value:
+        explorer, _, seconds = v.partition('=')
+        try:
+            ttls[explorer] = int(seconds)
+        except ValueError:
+            raise click.BadParameter('expected explorer=seconds, got: %s' % v)
+    return ttls
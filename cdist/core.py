@@ -20,6 +20,10 @@
 #
 
 import os
+import sys
+import copy
+import shutil
+import tempfile
 
 import cconfig
 
@@ -27,9 +31,29 @@ import cconfig
 from . import exceptions
 
 
+# id of schema -> (schema, default values of its keys)
+_defaults = {}
+
+
+def schema_defaults(schema):
+    """Return a dictionary of the default values of the given schema's keys.
+
+    Computed once per schema and shared by everybody using it, so treat it
+    as read only.
+    """
+    try:
+        return _defaults[id(schema)][1]
+    except KeyError:
+        defaults = cconfig.from_schema(schema)
+        # keep a reference to the schema so its id is not reused
+        _defaults[id(schema)] = (schema, defaults)
+        return defaults
+
+
 class CdistType(dict):
     """Represents a cdist type.
     """
+    __slots__ = ('name', '__object_schema', '__parameter_specs')
 
     @classmethod
     def from_dir(cls, path, name=None):
@@ -42,8 +66,25 @@ class CdistType(dict):
         obj = cls(type_name)
         return cconfig.from_dir(path, obj=obj, schema=obj.schema)
 
+    @classmethod
+    def from_data(cls, name, data, parameter_specs=None):
+        """Create a cdist type from the plain data previously returned by
+        `to_data`, see type_cache.TypeCache.
+        """
+        obj = cls(name)
+        obj.update(data)
+        if parameter_specs is not None:
+            obj.__parameter_specs = [tuple(spec) for spec in parameter_specs]
+        return obj
+
+    def to_data(self):
+        """Return the content of this type as plain, json serializable data.
+        """
+        return dict(self)
+
     schema_decl = (
         # path, type, subschema
+        ('concurrent-gencode', bool),
         ('explorer', 'listdir'),
         ('install', bool),
         ('parameter', dict, (
@@ -61,8 +102,30 @@ class CdistType(dict):
 
     def __init__(self, name):
         super().__init__(cconfig.from_schema(self.schema))
-        self.name = name
+        self.name = sys.intern(name)
         self.__object_schema = None
+        self.__parameter_specs = None
+
+    @property
+    def parameter_specs(self):
+        """List of (name, required, multiple, boolean, default) tuples
+        describing the parameters of this type.
+        """
+        if self.__parameter_specs is None:
+            parameter = self['parameter']
+            defaults = parameter['default']
+            specs = []
+            for parameter_type, required, multiple, boolean in (
+                    ('required', True, False, False),
+                    ('required_multiple', True, True, False),
+                    ('optional', False, False, False),
+                    ('optional_multiple', False, True, False),
+                    ('boolean', False, False, True)):
+                for name in parameter[parameter_type]:
+                    default = None if boolean else defaults.get(name, None)
+                    specs.append((name, required, multiple, boolean, default))
+            self.__parameter_specs = specs
+        return self.__parameter_specs
 
     @property
     def object_schema(self):
@@ -112,11 +175,14 @@ class CdistType(dict):
             _object['tags'].update(tags)
         return _object
 
-    def object_from_dir(self, path):
+    def object_from_dir(self, path, object_id=None):
         """Load a cdist object instance from an existing directory.
+
+        If the object id is known it is not read from disk.
         """
-        _object = CdistObject.from_dir(self.object_schema, path)
-        return _object
+        if object_id is None:
+            return CdistObject.from_dir(self.object_schema, path)
+        return CdistObject.from_dir(self.object_schema, path, type_name=self.name, object_id=object_id)
 
     def __repr__(self):
         return '<CdistType %s>' % self.name
@@ -130,39 +196,175 @@ class CdistType(dict):
 
 class CdistObject(dict):
     """Represents a cdist object.
+
+    Objects are used as and looked up by name everywhere, so the name is
+    computed once and interned. Attributes are slotted and keys only get
+    their own copy of the schema's default value, or are only read from
+    disk for objects loaded from a directory, when first accessed to keep
+    large numbers of objects small. Apart from that an object behaves like
+    a dictionary holding all the keys of its schema.
     """
+    __slots__ = ('schema', '__synced', '__name', '__path')
 
     @classmethod
-    def from_dir(cls, schema, path):
+    def from_dir(cls, schema, path, type_name=None, object_id=None):
         """Load a cdist object instance from the given directory.
+
+        Keys are read from disk when they are first accessed. If the type
+        name and object id are given they are not read at all.
         """
-        obj = cls(schema)
-        return cconfig.from_dir(path, obj=obj, schema=obj.schema)
+        obj = cls(schema, type_name=type_name, object_id=object_id)
+        obj.__path = path
+        if type_name is None:
+            dict.__delitem__(obj, 'type')
+            dict.__delitem__(obj, 'object-id')
+        obj.mark_synced()
+        return obj
 
     def to_dir(self, path, keys=None):
         """Store this cdist object instance in the given directory.
         """
         cconfig.to_dir(path, self, schema=self.schema, keys=keys)
+        self.mark_synced(keys)
+
+    def store(self, path, keys=None):
+        """Store the keys of this cdist object instance, out of the given
+        ones or all, which changed since it was last loaded or stored in the
+        given directory. Each key is replaced atomically.
+
+        Returns the list of keys that were written.
+        """
+        dirty = self.dirty_keys(keys)
+        if not dirty:
+            return dirty
+        tmp_path = tempfile.mkdtemp(prefix='.store-', dir=path)
+        try:
+            cconfig.to_dir(tmp_path, self, schema=self.schema, keys=dirty)
+            for key in dirty:
+                source = os.path.join(tmp_path, key)
+                destination = os.path.join(path, key)
+                if os.path.isdir(destination) and not os.path.islink(destination):
+                    # directories can not be replaced in one step, move the
+                    # old one out of the way to be removed with the tmp dir
+                    os.rename(destination, os.path.join(tmp_path, '.old-' + key))
+                elif os.path.lexists(destination) and not os.path.lexists(source):
+                    os.unlink(destination)
+                if os.path.lexists(source):
+                    os.replace(source, destination)
+        finally:
+            shutil.rmtree(tmp_path)
+        self.mark_synced(dirty)
+        return dirty
+
+    def dirty_keys(self, keys=None):
+        """Return the keys, out of the given ones or all, whose values
+        changed since this object was last loaded or stored.
+
+        Keys which were never accessed can not have changed.
+        """
+        synced = self.__synced or {}
+        return [key for key in (keys or self)
+            if dict.__contains__(self, key) and synced.get(key) != self.fingerprint(key)]
+
+    def mark_synced(self, keys=None):
+        """Remember the given keys, or all, as being the same as on disk."""
+        if self.__synced is None:
+            # key -> fingerprint of its value when last loaded or stored
+            self.__synced = {}
+        for key in (keys or self):
+            if dict.__contains__(self, key):
+                self.__synced[key] = self.fingerprint(key)
+
+    def fingerprint(self, key):
+        return hash(repr(self[key]))
 
     def __init__(self, schema, type_name=None, object_id=None):
         self.schema = schema
-        super().__init__(cconfig.from_schema(self.schema))
+        self.__synced = None
+        self.__name = None
+        # directory to load keys from on first access
+        self.__path = None
+        super().__init__()
         self['type'] = type_name
         self['object-id'] = object_id
 
+    def __missing__(self, key):
+        defaults = schema_defaults(self.schema)
+        if key not in defaults:
+            raise KeyError(key)
+        if self.__path is None:
+            value = copy.deepcopy(defaults[key])
+            dict.__setitem__(self, key, value)
+        else:
+            value = self.schema[key].from_path(os.path.join(self.__path, key))
+            # through __setitem__ to intern the type name and object id
+            self[key] = value
+            value = dict.__getitem__(self, key)
+            self.mark_synced([key])
+        return value
+
+    def __contains__(self, key):
+        return key in schema_defaults(self.schema) or dict.__contains__(self, key)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def keys(self):
+        keys = list(schema_defaults(self.schema))
+        keys.extend(key for key in dict.keys(self) if key not in schema_defaults(self.schema))
+        return keys
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def __setitem__(self, key, value):
+        if key in ('type', 'object-id'):
+            self.__name = None
+            if isinstance(value, str):
+                value = sys.intern(value)
+        super().__setitem__(key, value)
+
+    def update(self, *args, **kwargs):
+        self.__name = None
+        super().update(*args, **kwargs)
+
     @property
     def name(self):
-        if self['object-id']:
-            return os.path.join(self['type'], self['object-id'])
-        else:
-            return self['type']
+        if self.__name is None:
+            if self['object-id']:
+                name = os.path.join(self['type'], self['object-id'])
+            else:
+                name = self['type']
+            self.__name = sys.intern(name) if name else name
+        return self.__name
 
     def __repr__(self):
         return '<CdistObject %s>' % self.name
 
-#    def __eq__(self, other):
-#        """define equality as 'name is the same'"""
-#        return self.name == other.name
+    def __eq__(self, other):
+        """Objects are equal if they have the same type and object id.
+
+        Comparing their keys like a dict would only see the loaded ones.
+        """
+        if not isinstance(other, CdistObject):
+            return NotImplemented
+        return self.name == other.name
+
+    def __ne__(self, other):
+        # dict.__ne__ would compare the loaded keys
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
 
     def __hash__(self):
         return hash(self.name)
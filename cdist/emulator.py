@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+#
+# 2015 Steven Armstrong (steven-cdist at armstrong.cc)
+#
+# This file is part of cdist.
+#
+# cdist is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cdist is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cdist. If not, see <http://www.gnu.org/licenses/>.
+#
+#
+
+import os
+import sys
+
+import click
+
+from cdist import exceptions
+from cdist.core import CdistObject
+from cdist import util
+
+
+__get_env_default = '__something_a_user_will_never_use__'
+def get_env(name, default=__get_env_default, environ=None):
+    """Return the value of the given environment variable or raise
+    a `MissingRequiredEnvironmentVariableError` if it is not defined.
+    """
+    if environ is None:
+        environ = os.environ
+    try:
+        return environ[name]
+    except KeyError as e:
+        if default is not __get_env_default:
+            return default
+        raise exceptions.MissingRequiredEnvironmentVariableError(e.args[0])
+
+
+class EnvironOption(click.Option):
+    """A click option which reads its envvar from the given environment
+    instead of from os.environ.
+    """
+    def __init__(self, *args, environ=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.environ = os.environ if environ is None else environ
+
+    def resolve_envvar_value(self, ctx):
+        if self.envvar is None:
+            return None
+        return self.environ.get(self.envvar)
+
+
+class EmulatorCommand(click.Command):
+    """Creates a cdist object from the arguments a `__type` was called with.
+
+    environ is the environment of the manifest that called the type, stdin
+    a binary stream or None if there is nothing to read.
+    """
+    def __init__(self, log, runtime, type_name, stdin=sys.stdin.buffer, environ=None):
+        self.log = log
+        self._runtime = runtime
+        self._type_name = type_name
+        self._stdin = stdin
+        self._environ = os.environ if environ is None else environ
+        self._type = runtime.get_type(self._type_name)
+        super().__init__(type_name, callback=self.run, params=self.get_type_params())
+
+    @property
+    def dependency(self):
+        return self._runtime.dependency
+
+    def get_env(self, name, *default):
+        return get_env(name, *default, environ=self._environ)
+
+    def get_type_params(self):
+        params = []
+
+        # tags
+        params.append(click.Option(('--if-tag',), multiple=True,
+            callback=util.comma_delimited_string_to_set,
+            help='only apply this object if cdist is run with this tag'))
+        params.append(click.Option(('--not-if-tag',), multiple=True,
+            callback=util.comma_delimited_string_to_set,
+            help='do not apply this object if cdist is run with this tag'))
+
+        # dependencies
+        #    envvar='__cdist_require',
+        # FIXME: change envvar to envvar='__cdist_require'. But beware, breaks compat with existing manifests
+        params.append(EnvironOption(('--require',), multiple=True, environ=self._environ,
+            callback=util.space_delimited_string_to_set,
+            envvar='require',
+            help='require the given object to be fully realised before running this object'))
+        params.append(EnvironOption(('--after',), multiple=True, environ=self._environ,
+            callback=util.space_delimited_string_to_set,
+            envvar='__cdist_after',
+            help='realize this object after the given one'))
+        params.append(EnvironOption(('--before',), multiple=True, environ=self._environ,
+            callback=util.space_delimited_string_to_set,
+            envvar='__cdist_before',
+            help='realize this object before the given one'))
+
+        # type specific parameters
+        for param_name, required, multiple, boolean, default in self._type.parameter_specs:
+            if boolean:
+                _option = click.Option(('--'+ param_name,), is_flag=True)
+            else:
+                _option = click.Option(('--'+ param_name,), required=required, multiple=multiple, default=default)
+            _option.name = param_name
+            params.append(_option)
+
+        if not self._type['singleton']:
+            params.append(click.Argument(('object_id',), nargs=1))
+        return params
+
+    chunk_size = 65536
+    def _read_stdin(self):
+        return self._stdin.read(self.chunk_size)
+
+    def save_stdin(self, cdist_object):
+        """If something is written to stdin, save it in the object as
+        $__object/stdin so it can be accessed in manifest and gencode-*
+        scripts.
+        """
+        if self._stdin is not None and not self._stdin.isatty():
+            try:
+                # go directly to file instead of using CdistObject's api
+                # as that does not support streaming
+                path = self._runtime.get_object_path(cdist_object, 'local', 'stdin')
+                with open(path, 'wb') as fd:
+                    chunk = self._read_stdin()
+                    while chunk:
+                        fd.write(chunk)
+                        chunk = self._read_stdin()
+            except EnvironmentError as e:
+                raise exceptions.CdistError('Failed to read from stdin: %s' % e)
+
+    def run(self, *args, **kwargs):
+        self.log.debug('args: %s', args)
+        self.log.debug('kwargs: %s', kwargs)
+        self.log.debug('type: %s', self._type)
+
+        # Validate options
+        if_tag = kwargs.pop('if_tag')
+        not_if_tag = kwargs.pop('not_if_tag')
+        if not if_tag.isdisjoint(not_if_tag):
+            raise exceptions.ConflictingTagsError('Options \'if-tag\' and \'not-if-tag\' have conflicting values: %s vs %s' % (if_tag, not_if_tag))
+
+        tags = {
+            'if': if_tag,
+            'not-if': not_if_tag,
+        }
+        self.log.debug('tags: {0}'.format(tags))
+
+        # Take dependencies out of kwargs for later processing
+        deps = {
+            'require': kwargs.pop('require'),
+            'after': kwargs.pop('after'),
+            'before': kwargs.pop('before'),
+        }
+
+        # Validate object id
+        object_id = None
+        if not self._type['singleton']:
+            object_id = kwargs.pop('object_id')
+            object_id = CdistObject.sanitise_object_id(object_id)
+            CdistObject.validate_object_id(object_id)
+
+
+        _object_name = CdistObject.join_name(self._type.name, object_id)
+
+        # Remember in which manifest the object was defined
+        _source = self.get_env('__cdist_manifest')
+
+        # Check if object exists with conflicting parameters
+        if self._runtime.object_exists(_object_name):
+            self.log.info('object exists: %s', _object_name)
+            #print('object exists: %s' %  _object_name)
+            _object = self._runtime.get_object(_object_name)
+            if _object['parameter'] != kwargs:
+                self.log.error('%s : %s', _object['parameter'], kwargs)
+                # TODO: more infos in error message
+                raise exceptions.CdistError('Object %s already exists with conflicting parameters' % _object)
+            if _object['tags'] != tags:
+                self.log.error('%s : %s', _object['tags'], tags)
+                # TODO: more infos in error message
+                raise exceptions.CdistError('Object %s already exists with conflicting tags' % _object)
+            _object['source'].append(_source)
+
+        else:
+            # Instantiate new object
+            _object = self._type(object_id=object_id, parameters=kwargs, tags=tags)
+            _object['source'].append(_source)
+            # Create object on disk
+            self._runtime.create_object(_object)
+
+        self.log.debug('object: %s', _object)
+
+        # Save stdin if any
+        self.save_stdin(_object)
+
+        # Register dependencies
+        son = CdistObject.sanitise_object_name
+        for name in deps['require']:
+            self.dependency.require(_object.name, son(name))
+        for name in deps['before']:
+            self.dependency.before(_object.name, son(name))
+        for name in deps['after']:
+            self.dependency.after(_object.name, son(name))
+        __object_name = self.get_env('__object_name', None)
+        if __object_name:
+            self.dependency.auto(son(__object_name), _object.name)
+
+        self._runtime.blocking_sync_object(_object, 'source')
+
+
+def emulate(log, runtime, type_name, args, environ=None, stdin=None):
+    """Create or update the object defined by calling the given type with
+    the given arguments.
+
+    Returns a tuple of exit code and error message which is None on success.
+    """
+    try:
+        cmd = EmulatorCommand(log, runtime, type_name, stdin=stdin, environ=environ)
+        cmd.main(args=list(args), prog_name=type_name, standalone_mode=False)
+    except click.ClickException as e:
+        return e.exit_code, e.format_message()
+    except exceptions.CdistError as e:
+        return 1, str(e)
+    return 0, None
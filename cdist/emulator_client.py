@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+#
+# 2015 Steven Armstrong (steven-cdist at armstrong.cc)
+#
+# This file is part of cdist.
+#
+# cdist is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cdist is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cdist. If not, see <http://www.gnu.org/licenses/>.
+#
+#
+
+"""Lightweight entry point for the type emulator.
+
+Every `__type` call in a manifest runs this, so it only imports what it
+needs: the standard library and cdist.rpc to forward the call to the
+running cdist process, and the full emulator only if that is not possible.
+"""
+
+import time
+_started = time.time()
+
+import os
+import sys
+
+
+def forward(socket_path, type_name, type_args, stdin=None):
+    """Forward the emulator call to the cdist process listening on the
+    given unix socket and return the exit code.
+    """
+    from cdist import rpc
+
+    if stdin is None:
+        stdin = sys.stdin.buffer
+    has_stdin = not stdin.isatty()
+    payload = stdin.read() if has_stdin else b''
+    header = {
+        'type': type_name,
+        'args': list(type_args),
+        'environ': dict(os.environ),
+        'stdin': has_stdin,
+    }
+    response, unused_payload = rpc.call(socket_path, header, payload)
+    if response['error']:
+        sys.stderr.write('ERROR: %s\n' % response['error'])
+    return response['exit-code']
+
+
+def emulate(type_name, type_args):
+    """Create the object in this process and return the exit code."""
+    import logging
+    from cdist import target
+    from cdist import runtime
+    from cdist.emulator import get_env, emulate
+
+    log = logging.getLogger('cdist')
+    local_session_dir = get_env('__cdist_local_session')
+    remote_session_dir = get_env('__cdist_remote_session')
+    _target = target.Target.from_dir(get_env('__cdist_local_target'))
+    _runtime = runtime.Runtime(_target, local_session_dir, remote_session_dir, logger=log)
+    exit_code, error = emulate(log, _runtime, type_name, type_args, stdin=sys.stdin.buffer)
+    if error:
+        log.error(error)
+    return exit_code
+
+
+def run(type_name, type_args):
+    """Create the object defined by calling the given type with the given
+    arguments and return the exit code.
+
+    Forwards the call to the running cdist process if it is listening and
+    creates the object in this process otherwise.
+    """
+    exit_code = None
+    socket_path = os.environ.get('__cdist_emulator_socket')
+    if socket_path:
+        try:
+            exit_code = forward(socket_path, type_name, type_args)
+        except (FileNotFoundError, ConnectionRefusedError):
+            pass
+    if exit_code is None:
+        import logging
+        logging.basicConfig(level=logging.ERROR, format='%(levelname)s: %(message)s', stream=sys.stderr)
+        log_level = os.environ.get('__cdist_log_level', 'ERROR').upper()
+        if log_level in ('DEBUG', 'INFO'):
+            logging.getLogger('cdist').setLevel(log_level)
+        try:
+            exit_code = emulate(type_name, type_args)
+        except KeyboardInterrupt:
+            exit_code = 2
+    return exit_code
+
+
+def main():
+    type_name = os.path.basename(sys.argv[0])
+    type_args = sys.argv[1:]
+    debug = os.environ.get('__cdist_log_level', '').upper() == 'DEBUG'
+    if debug:
+        sys.stderr.write('DEBUG: %s: started in %.3fs (%.3fs cpu)\n' % (
+            type_name, time.time() - _started, time.process_time()))
+
+    exit_code = run(type_name, type_args)
+
+    if debug:
+        sys.stderr.write('DEBUG: %s: done in %.3fs\n' % (type_name, time.time() - _started))
+    sys.exit(exit_code)
+
+
+if __name__ == '__main__':
+    main()
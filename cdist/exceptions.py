@@ -47,12 +47,13 @@ class MissingRequiredEnvironmentVariableError(CdistError):
 class CircularReferenceError(CdistError):
     """Raised if a circular reference between objects is detected.
     """
-    def __init__(self, cdist_object, required_object):
-        self.cdist_object = cdist_object
-        self.required_object = required_object
+    def __init__(self, path):
+        # list of object names where each requires the next one and the
+        # last one is the same as the first
+        self.path = path
 
     def __str__(self):
-        return 'Circular reference detected: %s -> %s' % (self.cdist_object.name, self.required_object.name)
+        return 'Circular reference detected: %s' % ' -> '.join(self.path)
 
 
 class RequirementNotFoundError(CdistError):
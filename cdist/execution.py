@@ -20,16 +20,167 @@
 #
 
 import os
+import io
+import sys
 import glob
+import shlex
 import shutil
+import stat
+import hashlib
+import binascii
+import tarfile
 import asyncio
 import subprocess
+import contextlib
+import collections
+import time
+import re
 import logging
 log = logging.getLogger(__name__)
 
+from . import exceptions
+from .batch import Batch
+from .scheduler import FairSemaphore
+
+
+def private_tmp_script(name, wait=False):
+    """Return shell code which creates a directory only accessible by the
+    current user, named after the given name and the shell's pid, in
+    $__cdist_tmp and removes it when the shell exits.
+
+    With wait the shell waits for its background jobs before removing it.
+    """
+    return '\n'.join((
+        '__cdist_tmp="${TMPDIR:-/tmp}/%s.$$"' % name,
+        'mkdir -m 0700 "$__cdist_tmp" || exit 1',
+        "trap '%srm -rf \"$__cdist_tmp\"' EXIT" % ('wait; ' if wait else ''),
+    )) + '\n'
+
+
+def parse_status(output, commands):
+    """Parse the output of a script which runs the given commands one after
+    the other and prints a line of the form
+
+        <index> <exit status>\n
+
+    after each of them.
+
+    Return a list with None for each command which succeeded and a
+    `subprocess.CalledProcessError` for each one which failed.
+    """
+    status = {}
+    for line in output.decode().splitlines():
+        index, returncode = line.split()
+        status[int(index)] = int(returncode)
+    results = []
+    for index, command in enumerate(commands):
+        returncode = status.get(index)
+        if returncode == 0:
+            results.append(None)
+        else:
+            # a missing status means the shell died before running it
+            results.append(subprocess.CalledProcessError(
+                255 if returncode is None else returncode, command))
+    return results
+
+
+class AdaptiveSemaphore(object):
+    """A semaphore whose limit grows while the latency of the guarded
+    commands stays flat and is halved when the transport runs out of
+    sessions, e.g. because of sshd's MaxSessions.
+
+    Supports the same `with (await semaphore):` idiom as asyncio.Semaphore.
+    """
+
+    # Grow when the average latency is within this factor of the best seen
+    tolerance = 1.5
+
+    def __init__(self, limit, maximum=64, loop=None):
+        self.limit = limit
+        self.maximum = max(limit, maximum)
+        self.loop = loop or asyncio.get_event_loop()
+        self.active = 0
+        self.waiters = collections.deque()
+        self.latency = None
+        self.baseline = None
+        self.successes = 0
+
+    def __repr__(self):
+        return '<AdaptiveSemaphore limit:%d active:%d waiters:%d>' % (
+            self.limit, self.active, len(self.waiters))
+
+    async def acquire(self):
+        while self.active >= self.limit:
+            waiter = asyncio.Future(loop=self.loop)
+            self.waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+        self.active += 1
+        return True
+
+    def release(self):
+        self.active -= 1
+        self._wake_up()
+
+    def _wake_up(self):
+        available = self.limit - self.active
+        while available > 0 and self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                available -= 1
+
+    def __enter__(self):
+        raise RuntimeError('"await" should be used as context manager expression')
+
+    def __exit__(self, *args):
+        pass
+
+    def __await__(self):
+        yield from self.acquire().__await__()
+        return contextlib.closing(_Releaser(self))
+
+    def success(self, duration):
+        """Record the duration of a successful command."""
+        if self.latency is None:
+            self.latency = duration
+        else:
+            self.latency = 0.8 * self.latency + 0.2 * duration
+        if self.baseline is None or self.latency < self.baseline:
+            self.baseline = self.latency
+        self.successes += 1
+        # grow by one after a full window of successes at the current limit
+        if self.successes >= self.limit and self.limit < self.maximum:
+            if self.latency <= self.baseline * self.tolerance:
+                self.limit += 1
+                log.debug('adaptive limit increased: %s', self)
+                self._wake_up()
+            self.successes = 0
+
+    def backoff(self):
+        """Record that the transport refused to open another session."""
+        self.limit = max(1, self.limit // 2)
+        self.successes = 0
+        log.debug('adaptive limit decreased: %s', self)
+
+
+class _Releaser(object):
+    def __init__(self, semaphore):
+        self.semaphore = semaphore
+
+    def close(self):
+        self.semaphore.release()
+
 
 class Base(object):
 
+    # Number of times a command is retried when the transport refused to
+    # open a session for it
+    retries = 5
+
     def __init__(self, runtime):
         self.runtime = runtime
         self.environ = runtime.environ.copy()
@@ -39,24 +190,46 @@ class Base(object):
         #self.exec_semaphore = asyncio.Semaphore(20)
         # Default MaxSessions in sshd_config is 10
         self.copy_semaphore = self.exec_semaphore = asyncio.Semaphore(5)
+        # Session wide limit shared fairly with all other targets,
+        # see scheduler.ProcessBudget
+        self.process_budget = FairSemaphore(loop=runtime.loop)
+        # Pipe stderr of commands through `completed`
+        self.capture_stderr = False
 
+    def completed(self, semaphore, duration, returncode, errors):
+        """Called after each command with the semaphore it held, how long it
+        took, its exit status and its stderr if it was captured.
+
+        Returns True if the command should be retried.
+        """
+        if errors:
+            sys.stderr.buffer.write(errors)
+            sys.stderr.flush()
+        return False
 
     async def call(self, *args, timeout=None, **kwargs):
         """asyncio compatible implementation of subprocess.call
         """
-        with (await self.exec_semaphore):
-            process = await self.exec(*args, **kwargs)
-            try:
-                if timeout is None:
-                    returncode = await process.wait()
-                else:
-                    task = asyncio.ensure_future(process.wait())
-                    returncode = await asyncio.wait_for(task, timeout)
-                return returncode
-            except:
-                process.kill()
-                await process.wait()
-                raise
+        if self.capture_stderr:
+            kwargs.setdefault('stderr', subprocess.PIPE)
+        for attempt in range(self.retries + 1):
+            with (await self.exec_semaphore), (await self.process_budget(self.runtime)):
+                started = time.time()
+                process = await self.exec(*args, **kwargs)
+                try:
+                    if timeout is None:
+                        unused_output, errors = await process.communicate()
+                    else:
+                        task = asyncio.ensure_future(process.communicate())
+                        unused_output, errors = await asyncio.wait_for(task, timeout)
+                except:
+                    process.kill()
+                    await process.wait()
+                    raise
+            duration = time.time() - started
+            if not self.completed(self.exec_semaphore, duration, process.returncode, errors):
+                break
+        return process.returncode
 
     async def check_call(self, *args, **kwargs):
         """asyncio compatible implementation of subprocess.check_call
@@ -81,49 +254,430 @@ class Base(object):
             kwargs['stdin'] = subprocess.PIPE
         else:
             inputdata = None
-
-        with (await self.exec_semaphore):
-            process = await self.exec(*args, stdout=subprocess.PIPE, **kwargs)
-            try:
-                if timeout is None:
-                    output, unused_err = await process.communicate(inputdata)
-                else:
-                    task = asyncio.ensure_future(process.communicate(inputdata))
-                    output, unused_err = await asyncio.wait_for(task, timeout)
-            except subprocess.TimeoutExpired:
-                process.kill()
-                output, unused_err = await process.communicate()
-                raise subprocess.TimeoutExpired(process.args, timeout, output=output)
-            except:
-                process.kill()
-                await process.wait()
-                raise
-            if process.returncode:
-                command = kwargs.get('args')
-                if command is None:
-                    command = args[0]
-                raise subprocess.CalledProcessError(process.returncode, command, output=output)
-            return output
+        if self.capture_stderr:
+            kwargs.setdefault('stderr', subprocess.PIPE)
+
+        for attempt in range(self.retries + 1):
+            with (await self.exec_semaphore), (await self.process_budget(self.runtime)):
+                started = time.time()
+                process = await self.exec(*args, stdout=subprocess.PIPE, **kwargs)
+                try:
+                    if timeout is None:
+                        output, errors = await process.communicate(inputdata)
+                    else:
+                        task = asyncio.ensure_future(process.communicate(inputdata))
+                        output, errors = await asyncio.wait_for(task, timeout)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+                    output, errors = await process.communicate()
+                    raise subprocess.TimeoutExpired(process.args, timeout, output=output)
+                except:
+                    process.kill()
+                    await process.wait()
+                    raise
+            duration = time.time() - started
+            if not self.completed(self.exec_semaphore, duration, process.returncode, errors):
+                break
+        if process.returncode:
+            command = kwargs.get('args')
+            if command is None:
+                command = args[0]
+            raise subprocess.CalledProcessError(process.returncode, command, output=output)
+        return output
 
 
 class Remote(Base):
 
+    # stderr of ssh when sshd refused to open another session on a
+    # multiplexed connection
+    channel_error = re.compile(
+        rb'channel \d+: open failed|session request failed|MaxSessions')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Limit number of concurrent copy and exec processes. Can be set per
+        # target using the query part of the target url, e.g.
+        #   ssh://host?exec-limit=10&copy-limit=5&adaptive=yes
+        # and otherwise defaults to the runtime's limits.
+        limits = dict(self.runtime.limits)
+        limits.update(self.runtime.target.options)
+        exec_limit = int(limits.get('exec-limit') or 5)
+        copy_limit = limits.get('copy-limit')
+        self.adaptive = limits.get('adaptive') in (True, 'yes', 'true', '1')
+        if self.adaptive:
+            loop = self.runtime.loop
+            self.exec_semaphore = AdaptiveSemaphore(exec_limit, loop=loop)
+            self.copy_semaphore = AdaptiveSemaphore(int(copy_limit or exec_limit), loop=loop)
+            self.capture_stderr = True
+        elif copy_limit:
+            self.exec_semaphore = asyncio.Semaphore(exec_limit)
+            self.copy_semaphore = asyncio.Semaphore(int(copy_limit))
+        else:
+            # copy and exec share the same sessions
+            self.copy_semaphore = self.exec_semaphore = asyncio.Semaphore(exec_limit)
+        if self.runtime.budget:
+            self.process_budget = self.runtime.budget.remote
+
+        # How files are sent to the target:
+        #   tar: pack whole trees into one tar stream piped through remote-exec
+        #   copy: run the remote-copy script once per file
+        #   dedup: like tar, but only send the files whose content is not in
+        #          the blob store on the target yet, see `_transfer_dedup`
+        self.transfer_mode = limits.get('transfer-mode') or os.environ.get('CDIST_TRANSFER_MODE', 'tar')
+        # hashes of the blobs known to be in the target's blob store
+        self.blobs = set()
+        # whether unused blobs were removed from the blob store in this run
+        self.blobs_pruned = False
+        # Keep conf directories like explorers in a persistent directory on
+        # the target and only send what changed since the last run, see `sync`
+        sync_conf = self.runtime.target.options.get('sync-conf', self.runtime.sync_conf)
+        self.sync_conf = sync_conf in (True, 'yes', 'true', '1')
+        # Optional persistent shell on the target, see `start_shell`
+        self.shell = None
+        self.filesystem = RemoteFilesystemBatch(self)
+
+    async def start_shell(self):
+        """Start a persistent shell on the target through which subsequent
+        commands are run instead of spawning a remote-exec process for each.
+        """
+        if self.shell is None:
+            shell = RemoteShell(self)
+            await shell.start()
+            self.shell = shell
+
+    async def stop_shell(self):
+        """Stop the persistent shell if one is running."""
+        if self.shell is not None:
+            shell, self.shell = self.shell, None
+            await shell.stop()
+
+    def _use_shell(self, timeout, kwargs):
+        """Return True if a command with the given arguments can be run
+        through the persistent shell.
+        """
+        if self.shell is None or timeout is not None:
+            return False
+        if not set(kwargs).issubset(('env', 'shell', 'input')):
+            return False
+        # stdin is passed as a shell string which can not contain NUL bytes
+        return b'\0' not in (kwargs.get('input') or b'')
+
+    async def call(self, command, timeout=None, **kwargs):
+        if self._use_shell(timeout, kwargs):
+            returncode, output = await self.shell.run(command, **kwargs)
+            sys.stdout.buffer.write(output)
+            sys.stdout.flush()
+            return returncode
+        return await super().call(command, timeout=timeout, **kwargs)
+
+    async def check_output(self, command, timeout=None, **kwargs):
+        if self._use_shell(timeout, kwargs):
+            returncode, output = await self.shell.run(command, **kwargs)
+            if returncode:
+                raise subprocess.CalledProcessError(returncode, command, output=output)
+            return output
+        return await super().check_output(command, timeout=timeout, **kwargs)
+
+    def completed(self, semaphore, duration, returncode, errors):
+        if self.adaptive:
+            if returncode == 255 and errors and self.channel_error.search(errors):
+                log.debug('transport refused session: %s', errors)
+                semaphore.backoff()
+                return True
+            if not returncode:
+                semaphore.success(duration)
+        return super().completed(semaphore, duration, returncode, errors)
+
+    def enqueue(self, operation, *args):
+        """Enqueue a filesystem operation on the target and return a future
+        which is resolved once it has been executed.
+
+        All operations enqueued during one iteration of the event loop are
+        run together in a single remote shell script.
+
+        enqueue('mkdir', path)
+        enqueue('rmdir', path)
+        enqueue('chmod', mode, path)
+        """
+        return self.filesystem.submit((operation,) + args)
+
     async def mkdir(self, path):
         """Create directory on the target."""
         log.debug("Remote mkdir: %s", path)
-        await self.check_call(["mkdir", "-p", path])
+        await self.enqueue('mkdir', path)
 
     async def rmdir(self, path):
         """Remove directory on the target."""
         log.debug("Remote rmdir: %s", path)
-        await self.check_call(["rm", "-rf",  path])
+        await self.enqueue('rmdir', path)
+
+    async def chmod(self, mode, path):
+        """Change permissions of a file or directory on the target.
+        A trailing '/*' in path is expanded on the target.
+        """
+        log.debug("Remote chmod: %s %s", mode, path)
+        await self.enqueue('chmod', mode, path)
 
     async def transfer(self, source, destination):
         """Transfer a file or directory to the target."""
-        log.debug("Remote transfer: %s -> %s", source, destination)
-        await self.rmdir(destination)
+        await self.transfer_many({source: destination})
+
+    async def transfer_many(self, mapping):
+        """Transfer multiple files or directories to the target.
+
+        mapping is a dictionary of local source paths to remote destination
+        paths. Existing destinations are replaced.
+        """
+        if not mapping:
+            return
+        transfer_mode = self.transfer_mode
+        if transfer_mode == 'dedup':
+            try:
+                await self._transfer_dedup(mapping)
+                return
+            except subprocess.CalledProcessError as e:
+                # Only fall back for this call: the failure may be transient,
+                # e.g. a blob pruned by a concurrent run. Forget the blobs we
+                # believe the target has so the next call asks again.
+                log.warning('dedup transfer failed, falling back to tar for %s: %s',
+                    ', '.join(mapping.values()), e)
+                self.blobs.clear()
+                transfer_mode = 'tar'
+        if transfer_mode == 'tar':
+            try:
+                await self._transfer_tar(mapping)
+                return
+            except subprocess.CalledProcessError as e:
+                # The transport can not pipe stdin to the target, or there is
+                # no usable tar on the other end.
+                log.warning('tar transfer failed, falling back to remote-copy: %s', e)
+                self.transfer_mode = 'copy'
+        tasks = [asyncio.ensure_future(self._transfer_copy(source, destination))
+            for source, destination in mapping.items()]
+        await asyncio.gather(*tasks)
+
+    def _pack(self, mapping):
+        """Pack the given sources into an uncompressed tar archive using
+        their destinations relative to / as member names.
+        """
+        def reset_owner(tarinfo):
+            tarinfo.uid = tarinfo.gid = 0
+            tarinfo.uname = tarinfo.gname = 'root'
+            return tarinfo
+
+        buf = io.BytesIO()
+        # dereference as the local session is mostly a farm of symlinks
+        with tarfile.open(fileobj=buf, mode='w', dereference=True) as tar:
+            for source, destination in mapping.items():
+                tar.add(source, arcname=destination.lstrip('/'), filter=reset_owner)
+        return buf.getvalue()
+
+    async def _transfer_tar(self, mapping):
+        """Transfer all sources in a single tar stream through remote-exec."""
+        log.debug("Remote transfer (tar): %s", mapping)
+        data = await self.runtime.loop.run_in_executor(None, self._pack, mapping)
+        destinations = ' '.join(shlex.quote(d) for d in mapping.values())
+        code = 'rm -rf %s && tar -C / -xf -' % destinations
+        await self.check_output([shlex.quote(code)], input=data)
+
+    @property
+    def state_dir(self):
+        """The directory on the target where cdist keeps data between runs."""
+        return self.runtime.target['remote-state-dir'] or '/var/lib/cdist'
+
+    @property
+    def blob_store(self):
+        """The directory on the target holding the transferred files by the
+        hash of their content.
+        """
+        return os.path.join(self.state_dir, 'blobs')
+
+    @staticmethod
+    def _manifest(source):
+        """Return a dictionary of relative path to a tuple of content hash
+        and mode for all files in the given local directory.
+        """
+        manifest = {}
+        for path, dirnames, filenames in os.walk(source, followlinks=True):
+            for name in filenames:
+                file_path = os.path.join(path, name)
+                with open(file_path, 'rb') as fd:
+                    digest = hashlib.sha1(fd.read()).hexdigest()
+                mode = stat.S_IMODE(os.stat(file_path).st_mode)
+                manifest[os.path.relpath(file_path, source)] = (digest, '%o' % mode)
+        return manifest
+
+    # days after which unused synced directories are removed from the target
+    sync_max_age = 7
+
+    async def sync(self, source, destination):
+        """Make the given destination on the target a copy of the given local
+        directory.
+
+        The files are kept in a directory below the state directory on the
+        target which outlives the session. It is named after the hash of the
+        manifest of their content and modes, so it never changes once
+        created and may be shared by any number of sessions. The destination
+        is made a symlink to it.
+
+        A new directory is created from the one last synced to the same
+        destination, sending only the files which differ from it. It is
+        built in a temporary directory and moved into place under a lock.
+        Directories not used for `sync_max_age` days are removed.
+        """
+        relative = os.path.relpath(destination, self.runtime.remote_session_dir)
+        local = await self.runtime.loop.run_in_executor(None, self._manifest, source)
+        manifest = ''.join('%s %s %s\n' % (digest, mode, path)
+            for path, (digest, mode) in sorted(local.items()))
+        digest = hashlib.sha1(manifest.encode()).hexdigest()
+        cache = os.path.join(self.state_dir, 'cache')
+        content = os.path.join(cache, 'content')
+        persistent = os.path.join(content, digest)
+        latest = os.path.join(cache, 'latest', relative)
+
+        # find out whether the target has this content already, and if not
+        # the manifest of the content last synced to the same destination
+        code = '\n'.join((
+            'cd %s 2>/dev/null || exit 0' % shlex.quote(content),
+            '[ -f %s/.cdist-manifest ] && { echo present; exit 0; }' % digest,
+            'base=$(cat %s 2>/dev/null) || exit 0' % shlex.quote(latest),
+            '[ -f "$base/.cdist-manifest" ] && { echo "$base"; cat "$base/.cdist-manifest"; }',
+            'true',
+        ))
+        output = await self.check_output([shlex.quote(code)])
+        lines = output.decode().splitlines()
+        base = lines[0] if lines else None
+        remote = {}
+        for line in lines[1:]:
+            _digest, mode, path = line.split(' ', 2)
+            remote[path] = (_digest, mode)
+
+        lines = ['set -e']
+        data = None
+        if base == 'present':
+            log.debug('Remote sync: %s: up to date', destination)
+        else:
+            changed = sorted(path for path, entry in local.items() if remote.get(path) != entry)
+            removed = sorted(set(remote) - set(local))
+            log.debug('Remote sync: %s: %d changed, %d removed', destination, len(changed), len(removed))
+            tmp = os.path.join(content, '.tmp-%s' % binascii.hexlify(os.urandom(8)).decode())
+            lock = shlex.quote(os.path.join(content, '.lock'))
+            lines.append('mkdir -p %s' % shlex.quote(tmp))
+            if base:
+                lines.append('cp -R -p %s/. %s' % (shlex.quote(os.path.join(content, base)), shlex.quote(tmp)))
+            if changed:
+                data = await self.runtime.loop.run_in_executor(None, self._pack,
+                    {os.path.join(source, path): os.path.join(tmp, path) for path in changed})
+                lines.append('tar -C / -xf -')
+            if removed:
+                lines.append('rm -f %s' % ' '.join(shlex.quote(os.path.join(tmp, path)) for path in removed))
+            lines.append("cat > %s << 'CDIST_MANIFEST'\n%sCDIST_MANIFEST" % (
+                shlex.quote(os.path.join(tmp, '.cdist-manifest')), manifest))
+            lines.extend([
+                # break the lock of a run that died while holding it
+                'find %s -prune -mmin +10 -exec rmdir {} \\; 2>/dev/null || true' % lock,
+                'until mkdir %s 2>/dev/null; do sleep 1; done' % lock,
+                '[ -d %s ] || mv %s %s' % (shlex.quote(persistent), shlex.quote(tmp), shlex.quote(persistent)),
+                'rmdir %s' % lock,
+                'rm -rf %s' % shlex.quote(tmp),
+                'mkdir -p %s' % shlex.quote(os.path.dirname(latest)),
+                'echo %s > %s.$$' % (digest, shlex.quote(latest)),
+                'mv %s.$$ %s' % (shlex.quote(latest), shlex.quote(latest)),
+            ])
+        lines.extend([
+            # mark as used so it is not removed while sessions use it
+            'touch %s' % shlex.quote(persistent),
+            'find %s -mindepth 1 -maxdepth 1 -type d -mtime +%d -exec rm -rf {} + 2>/dev/null || true' % (
+                shlex.quote(content), self.sync_max_age),
+            'mkdir -p %s' % shlex.quote(os.path.dirname(destination)),
+            'rm -rf %s' % shlex.quote(destination),
+            'ln -s %s %s' % (shlex.quote(persistent), shlex.quote(destination)),
+        ])
+        await self.check_output([shlex.quote('\n'.join(lines))], input=data)
+
+    @staticmethod
+    def _scan(mapping):
+        """Return the list of destination directories and a list of tuples
+        of destination, content hash, source and mode of each file in the
+        given sources.
+        """
+        directories = []
+        files = []
+        for source, destination in mapping.items():
+            if not os.path.isdir(source):
+                directories.append(os.path.dirname(destination))
+                files.append((destination, source))
+                continue
+            directories.append(destination)
+            for path, dirnames, filenames in os.walk(source, followlinks=True):
+                base = os.path.normpath(os.path.join(destination, os.path.relpath(path, source)))
+                directories.extend(os.path.join(base, name) for name in dirnames)
+                files.extend((os.path.join(base, name), os.path.join(path, name)) for name in filenames)
+        entries = []
+        for destination, source in files:
+            with open(source, 'rb') as fd:
+                digest = hashlib.sha1(fd.read()).hexdigest()
+            entries.append((destination, digest, source, stat.S_IMODE(os.stat(source).st_mode)))
+        return directories, entries
+
+    # days after which unused blobs are removed from the target's blob store
+    blob_max_age = 7
+
+    async def _transfer_dedup(self, mapping):
+        """Transfer only the files whose content the target does not have in
+        its blob store yet and copy the blobs to the destinations.
+
+        Destinations are copies rather than hardlinks so that their modes,
+        and later changes to them, do not leak into the blob store and other
+        destinations with the same content.
+
+        Blobs are touched when found in the store and removed once they were
+        not used for `blob_max_age` days, by the first transfer of each run.
+        """
+        log.debug("Remote transfer (dedup): %s", mapping)
+        directories, entries = await self.runtime.loop.run_in_executor(None, self._scan, mapping)
+        store = self.blob_store
+        unknown = {digest for destination, digest, source, mode in entries} - self.blobs
+        missing = set()
+        if unknown:
+            # ask the target which of the blobs it already has
+            code = 'cd %s 2>/dev/null || exit 0\nfor h in %s; do [ -f "$h" ] && touch "$h" && echo "$h"; done\ntrue\n' % (
+                shlex.quote(store), ' '.join(sorted(unknown)))
+            output = await self.check_output(['/bin/sh'], input=code.encode())
+            present = set(output.decode().split())
+            self.blobs.update(present)
+            missing = unknown - present
+        lines = ['set -e']
+        data = None
+        if missing:
+            blobs = {}
+            for destination, digest, source, mode in entries:
+                if digest in missing:
+                    blobs[source] = os.path.join(store, digest)
+            data = await self.runtime.loop.run_in_executor(None, self._pack, blobs)
+            lines.append('tar -C / -xf -')
+        lines.append('rm -rf %s' % ' '.join(shlex.quote(d) for d in mapping.values()))
+        if directories:
+            lines.append('mkdir -p %s' % ' '.join(shlex.quote(d) for d in directories))
+        for destination, digest, source, mode in entries:
+            blob = shlex.quote(os.path.join(store, digest))
+            destination = shlex.quote(destination)
+            lines.append('cp -f %s %s' % (blob, destination))
+            lines.append('chmod %o %s' % (mode, destination))
+        if not self.blobs_pruned:
+            lines.append('find %s -type f -mtime +%d -exec rm -f {} + 2>/dev/null || true' % (
+                shlex.quote(store), self.blob_max_age))
+        log.debug('dedup transfer: %d files, %d blobs sent', len(entries), len(missing))
+        await self.check_output([shlex.quote('\n'.join(lines))], input=data)
+        self.blobs.update(missing)
+        self.blobs_pruned = True
+
+    async def _transfer_copy(self, source, destination):
+        """Transfer a file or directory using one remote-copy per file."""
+        log.debug("Remote transfer (copy): %s -> %s", source, destination)
         if os.path.isdir(source):
-            await self.mkdir(destination)
+            # enqueued together, run in order in one remote shell
+            await asyncio.gather(self.rmdir(destination), self.mkdir(destination))
             # copy files in parallel
             tasks = []
             for f in glob.glob1(source, '*'):
@@ -136,17 +690,14 @@ class Remote(Base):
             #    assert not pending
             await asyncio.gather(*tasks)
         else:
+            await asyncio.gather(self.rmdir(destination), self.mkdir(os.path.dirname(destination)))
             await self.copy(source, destination)
 
-    async def exec(self, command, **kwargs):
-        """Run the given command with the configured remote-exec script.
+    def remote_command(self, command, **kwargs):
+        """Return the list of words that make up the given command as it is
+        passed to the remote-exec script.
         """
-        log.debug('remote exec: command=%s, kwargs=%s', command, kwargs)
-        _command = [self.runtime.path['target']['exec']]
-
-        # export target_host for use in remote-{exec,copy} scripts
-        os_environ = os.environ.copy()
-        os_environ.update(self.environ)
+        _command = []
 
         # can't pass environment to remote side, so prepend command with
         # variable declarations
@@ -161,6 +712,20 @@ class Remote(Base):
                 _command.extend([os.environ.get('CDIST_REMOTE_SHELL', '/bin/sh') , '-e'])
 
         _command.extend(command)
+        return _command, kwargs
+
+    async def exec(self, command, **kwargs):
+        """Run the given command with the configured remote-exec script.
+        """
+        log.debug('remote exec: command=%s, kwargs=%s', command, kwargs)
+        _command = [self.runtime.path['target']['exec']]
+
+        # export target_host for use in remote-{exec,copy} scripts
+        os_environ = os.environ.copy()
+        os_environ.update(self.environ)
+
+        remote_command, kwargs = self.remote_command(command, **kwargs)
+        _command.extend(remote_command)
         code = ' '.join(_command)
         log.debug('remote exec: code=%s', code)
         process = await asyncio.create_subprocess_shell(code, env=os_environ, **kwargs)
@@ -170,18 +735,234 @@ class Remote(Base):
         """Copy the given source to destination using the configured
         remote-copy script.
         """
-        with (await self.copy_semaphore):
-            log.debug('copy: %s -> %s', source, destination)
+        log.debug('copy: %s -> %s', source, destination)
 
-            # export target_host for use in remote-{exec,copy} scripts
-            os_environ = os.environ.copy()
-            os_environ.update(self.environ)
+        # export target_host for use in remote-{exec,copy} scripts
+        os_environ = os.environ.copy()
+        os_environ.update(self.environ)
 
-            code = '%s %s %s' % (self.runtime.path['target']['copy'], source, destination)
-            process = await asyncio.create_subprocess_shell(code, stdout=asyncio.subprocess.PIPE, env=os_environ)
-            output, stderr = await process.communicate()
-            if process.returncode:
-                raise subprocess.CalledProcessError(process.returncode, code, output=output, stderr=stderr)
+        code = '%s %s %s' % (self.runtime.path['target']['copy'], source, destination)
+        stderr = subprocess.PIPE if self.capture_stderr else None
+        for attempt in range(self.retries + 1):
+            with (await self.copy_semaphore), (await self.process_budget(self.runtime)):
+                started = time.time()
+                process = await asyncio.create_subprocess_shell(code,
+                    stdout=asyncio.subprocess.PIPE, stderr=stderr, env=os_environ)
+                output, errors = await process.communicate()
+            duration = time.time() - started
+            if not self.completed(self.copy_semaphore, duration, process.returncode, errors):
+                break
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, code, output=output, stderr=errors)
+
+
+class RemoteFilesystemBatch(Batch):
+    """Runs all filesystem operations enqueued on a `Remote` during one
+    iteration of the event loop as a single shell script on the target.
+
+    Operations run in the order they were enqueued, so a caller can enqueue
+    dependent operations together, e.g. removing and then recreating a
+    directory. The script reports the exit status of each operation on
+    stdout and a failing operation only fails whoever enqueued it.
+    """
+
+    commands = {
+        'mkdir': 'mkdir -p',
+        'rmdir': 'rm -rf',
+        'chmod': 'chmod',
+    }
+
+    def __init__(self, remote):
+        super().__init__(loop=remote.runtime.loop)
+        self.remote = remote
+
+    @staticmethod
+    def quote(path):
+        if path.endswith('/*'):
+            return shlex.quote(path[:-2]) + '/*'
+        return shlex.quote(path)
+
+    def command(self, operation):
+        name, args, path = operation[0], operation[1:-1], operation[-1]
+        return ' '.join((self.commands[name],) + args + (self.quote(path),))
+
+    def script(self, operations):
+        """Return a shell script for the given operations which prints the
+        index and exit status of each of them.
+        """
+        lines = []
+        for index, operation in enumerate(operations):
+            lines.append(self.command(operation))
+            lines.append('echo %d "$?"' % index)
+        return '\n'.join(lines) + '\n'
+
+    async def process(self, operations):
+        script = self.script(operations)
+        log.debug('remote filesystem: %d operations:\n%s', len(operations), script)
+        output = await self.remote.check_output(['/bin/sh'], input=script.encode())
+        return parse_status(output, [self.command(operation) for operation in operations])
+
+
+class RemoteShell(object):
+    """A long lived shell on the target which is started once over the
+    remote-exec script and then runs commands sent to it on stdin.
+
+    Commands run concurrently, each in a background subshell which keeps
+    its output in files tagged with the command's id. Once a command is
+    done the subshell reports its exit status as a short line
+
+        <id> <status>\n
+
+    on the shell's stderr. The output is then collected by the shell
+    itself, which writes frames of the form
+
+        <id> stdout <length>\n<data>
+        <id> stderr <length>\n<data>
+
+    to its stdout. As only the shell writes to stdout and each status line
+    is written at once, frames and status lines never get mixed up.
+    """
+
+    prelude = private_tmp_script('cdist-shell', wait=True).encode() + b"""__cdist_frame() {
+   printf '%s %s %s\n' "$1" "$2" "$(wc -c < "$3" | tr -d ' ')"
+   cat "$3"
+}
+__cdist_collect() {
+   __cdist_frame "$1" stdout "$__cdist_tmp/$1.out"
+   __cdist_frame "$1" stderr "$__cdist_tmp/$1.err"
+   rm -f "$__cdist_tmp/$1.in" "$__cdist_tmp/$1.out" "$__cdist_tmp/$1.err"
+}
+"""
+
+    def __init__(self, remote):
+        self.remote = remote
+        self.process = None
+        self.counter = 0
+        # command id -> future of its exit status, stdout and stderr
+        self.pending = {}
+        # command id -> exit status of commands whose output is being collected
+        self.returncodes = {}
+        self.readers = []
+
+    async def start(self):
+        log.debug('remote shell: start')
+        self.process = await self.remote.exec(['/bin/sh'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.process.stdin.write(self.prelude)
+        await self.process.stdin.drain()
+        self.readers = [
+            asyncio.ensure_future(self.read_status()),
+            asyncio.ensure_future(self.read_frames()),
+        ]
+
+    async def stop(self):
+        log.debug('remote shell: stop')
+        if self.process.returncode is None:
+            self.process.stdin.write(b'exit 0\n')
+            self.process.stdin.close()
+            await self.process.wait()
+        for reader in self.readers:
+            reader.cancel()
+        self.fail(exceptions.CdistError('Persistent remote shell stopped'))
+
+    def fail(self, error):
+        """Fail all pending commands with the given error."""
+        pending, self.pending = self.pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(error)
+
+    @staticmethod
+    def quote(data):
+        """Quote the given bytes for use as a single shell word."""
+        return b"'" + data.replace(b"'", b"'\\''") + b"'"
+
+    def script(self, command_id, command, input=None, **kwargs):
+        """Return the shell code which runs the given command in the
+        background and reports its exit status.
+        """
+        remote_command, kwargs = self.remote.remote_command(command, **kwargs)
+        # the remote-exec script receives the command after it has been
+        # word split by the local shell, do the same
+        code = ' '.join(shlex.split(' '.join(remote_command)))
+        files = b'"$__cdist_tmp/%d' % command_id
+        lines = [
+            b'(',
+            b"printf '%s' " + self.quote(input or b'') + b' > ' + files + b'.in"',
+            b'( ' + code.encode() + b' ) < ' + files + b'.in" > ' + files + b'.out" 2> ' + files + b'.err"',
+            b"printf '%%s %%s\\n' %d \"$?\" >&2" % command_id,
+            b') &',
+        ]
+        return b'\n'.join(lines) + b'\n'
+
+    async def read_status(self):
+        """Read the exit status of finished commands from the shell's stderr
+        and ask the shell to send their output.
+        """
+        try:
+            while True:
+                line = await self.process.stderr.readline()
+                if not line:
+                    break
+                try:
+                    command_id, returncode = map(int, line.split())
+                except ValueError:
+                    # not ours, e.g. a warning of the transport
+                    sys.stderr.buffer.write(line)
+                    sys.stderr.flush()
+                    continue
+                self.returncodes[command_id] = returncode
+                self.process.stdin.write(b'__cdist_collect %d\n' % command_id)
+        finally:
+            self.fail(exceptions.CdistError('Persistent remote shell exited unexpectedly'))
+
+    async def read_frame(self):
+        header = await self.process.stdout.readline()
+        if not header:
+            raise asyncio.IncompleteReadError(header, None)
+        _id, kind, length = header.decode().split()
+        return int(_id), kind, await self.process.stdout.readexactly(int(length))
+
+    async def read_frames(self):
+        """Read the output of finished commands from the shell's stdout and
+        resolve their futures.
+        """
+        try:
+            while True:
+                command_id, unused_kind, output = await self.read_frame()
+                unused_id, unused_kind, errors = await self.read_frame()
+                future = self.pending.pop(command_id, None)
+                returncode = self.returncodes.pop(command_id)
+                if future is not None and not future.done():
+                    future.set_result((returncode, output, errors))
+        except asyncio.IncompleteReadError:
+            pass
+        finally:
+            self.fail(exceptions.CdistError('Persistent remote shell exited unexpectedly'))
+
+    async def run(self, command, **kwargs):
+        """Run the given command on the target and return a tuple of its
+        exit status and output. Anything written to stderr is passed on to
+        our own stderr.
+
+        At most as many commands as the target's exec limit run at the same
+        time.
+        """
+        with (await self.remote.exec_semaphore):
+            if self.process.returncode is not None:
+                raise exceptions.CdistError('Persistent remote shell exited unexpectedly')
+            self.counter += 1
+            command_id = self.counter
+            log.debug('remote shell: %d: command=%s, kwargs=%s', command_id, command, kwargs)
+            future = asyncio.Future(loop=self.remote.runtime.loop)
+            self.pending[command_id] = future
+            self.process.stdin.write(self.script(command_id, command, **kwargs))
+            await self.process.stdin.drain()
+            returncode, output, errors = await future
+        if errors:
+            sys.stderr.buffer.write(errors)
+            sys.stderr.flush()
+        return returncode, output
 
 
 class Local(Base):
@@ -191,12 +972,15 @@ class Local(Base):
         # Limit number of concurrent copy and exec processes
         self.copy_semaphore = asyncio.Semaphore(20)
         self.exec_semaphore = asyncio.Semaphore(20)
+        if self.runtime.budget:
+            self.process_budget = self.runtime.budget.local
 
         rtp = self.runtime.path
         self.environ.update({
             '__cdist_local_session': rtp['local']['session'],
             '__cdist_remote_session': rtp['remote']['session'],
             '__cdist_local_target': rtp['local']['target'],
+            '__cdist_emulator_socket': rtp['local']['emulator-socket'],
             '__remote_copy': rtp['target']['copy'],
             '__remote_exec': rtp['target']['exec'],
             'CDIST_INTERNAL': 'yes',
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+#
+# 2015 Steven Armstrong (steven-cdist at armstrong.cc)
+#
+# This file is part of cdist.
+#
+# cdist is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cdist is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cdist. If not, see <http://www.gnu.org/licenses/>.
+#
+#
+
+import os
+import json
+import time
+import hashlib
+import logging
+log = logging.getLogger(__name__)
+
+from .cache import cache_dir, JsonCache
+
+
+class ExplorerCache(JsonCache):
+    """Results of explorers from previous runs against a target.
+
+    An entry is keyed by the explorer, a hash of its script and, for type
+    explorers, the object name and parameters, so changing any of those
+    misses the cache. Entries expire after the TTL in seconds configured for
+    their explorer.
+
+    Global explorers are named by their name, e.g. 'memory', type explorers
+    by their type and name, e.g. '__file/stat'. Global explorers use the
+    default TTL unless configured otherwise. Type explorers look at what
+    cdist is about to change, so they are only cached if given a TTL
+    explicitly.
+
+    Usage:
+
+    cache = ExplorerCache.for_target(target, ttl=3600, ttls={'__package/state': 600})
+    value = cache.get('memory', script_path)
+    if value is None:
+        value = run_explorer()
+        cache.set('memory', script_path, value)
+    cache.save()
+    """
+
+    def __init__(self, path, ttl=None, ttls=None):
+        super().__init__(path)
+        self.ttl = ttl
+        self.ttls = ttls or {}
+        self.hits = 0
+        self.misses = 0
+        self.changed = False
+        self.__script_hashes = {}
+
+    def __repr__(self):
+        return '<ExplorerCache %s hits:%d misses:%d>' % (self.path, self.hits, self.misses)
+
+    @classmethod
+    def for_target(cls, target, ttl=None, ttls=None):
+        path = os.path.join(cache_dir(), 'explorer', target.identifier + '.json')
+        return cls(path, ttl=ttl, ttls=ttls)
+
+    def save(self):
+        if not self.changed:
+            return
+        self.write(self.path)
+        self.changed = False
+
+    def ttl_for(self, explorer):
+        if explorer in self.ttls:
+            return self.ttls[explorer]
+        if '/' in explorer:
+            return None
+        return self.ttl
+
+    def cacheable(self, explorer):
+        return bool(self.ttl_for(explorer))
+
+    def script_hash(self, script):
+        if script not in self.__script_hashes:
+            with open(script, 'rb') as fd:
+                self.__script_hashes[script] = hashlib.sha1(fd.read()).hexdigest()
+        return self.__script_hashes[script]
+
+    def key(self, explorer, script, object_name=None, parameters=None):
+        context = json.dumps([object_name, parameters], sort_keys=True)
+        digest = hashlib.sha1((self.script_hash(script) + context).encode()).hexdigest()
+        return '%s:%s' % (explorer, digest)
+
+    def get(self, explorer, script, object_name=None, parameters=None):
+        """Return the cached result of the given explorer or None if there
+        is no current one.
+        """
+        if not self.cacheable(explorer):
+            return None
+        entry = self.load().get(self.key(explorer, script, object_name, parameters))
+        if entry is None or time.time() - entry['time'] > self.ttl_for(explorer):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry['value']
+
+    def set(self, explorer, script, value, object_name=None, parameters=None):
+        if not self.cacheable(explorer):
+            return
+        self.load()[self.key(explorer, script, object_name, parameters)] = {
+            'time': time.time(),
+            'object': object_name,
+            'value': value,
+        }
+        self.changed = True
+
+    def invalidate(self, object_name=None):
+        """Drop the cached results for the given object, or all of them.
+        """
+        entries = self.load()
+        if object_name is None:
+            stale = list(entries)
+        else:
+            stale = [key for key, entry in entries.items() if entry['object'] == object_name]
+        for key in stale:
+            del entries[key]
+        if stale:
+            log.debug('invalidated %d cached explorer results', len(stale))
+            self.changed = True
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+#
+# 2015 Steven Armstrong (steven-cdist at armstrong.cc)
+#
+# This file is part of cdist.
+#
+# cdist is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cdist is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cdist. If not, see <http://www.gnu.org/licenses/>.
+#
+#
+
+import os
+import json
+import threading
+import logging
+log = logging.getLogger(__name__)
+
+
+class Journal(object):
+    """An append only file of json records, one per line.
+
+    Any number of processes may append to the same journal concurrently as
+    each record is written with a single write to a file opened with
+    O_APPEND. A reader remembers how far it has read and only returns the
+    records that were appended since its last read. Reading is thread safe,
+    each record is returned by only one of concurrent reads.
+
+    Usage:
+
+    writer = Journal('/path/to/journal')
+    writer.append({'object': '__file/etc/hosts'})
+
+    reader = Journal('/path/to/journal')
+    for record in reader.read():
+        ...
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+        self.__lock = threading.Lock()
+
+    def __repr__(self):
+        return '<Journal %s offset:%d>' % (self.path, self.offset)
+
+    def append(self, record):
+        """Append the given record to the journal."""
+        data = (json.dumps(record) + '\n').encode()
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+    def read(self):
+        """Return the list of records appended since the last read."""
+        with self.__lock:
+            start = self.offset
+            try:
+                with open(self.path, 'rb') as fd:
+                    fd.seek(start)
+                    data = fd.read()
+            except FileNotFoundError:
+                return []
+            # leave a partially written last record for the next read
+            end = data.rfind(b'\n') + 1
+            self.offset = start + end
+        return [json.loads(line.decode()) for line in data[:end].splitlines() if line]
@@ -1,3 +1,5 @@
+import re
+import bisect
 import fnmatch
 import asyncio
 import pprint
@@ -5,37 +7,123 @@ import pprint
 from cdist import exceptions
 
 
+class ObjectIndex(object):
+    """Index of object names for resolving requirement patterns.
+
+    Exact names are set lookups. Patterns without wildcards in their type
+    part are only matched against the objects of that type, narrowed down to
+    those whose object id starts with the literal prefix of the pattern.
+    """
+    magic = re.compile(r'[*?[]')
+
+    def __init__(self):
+        self.names = set()
+        # type name -> sorted list of object ids
+        self.types = {}
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, name):
+        if name in self.names:
+            return
+        self.names.add(name)
+        type_name, _, object_id = name.partition('/')
+        bisect.insort(self.types.setdefault(type_name, []), object_id)
+
+    def find(self, pattern):
+        """Return a list of the names matching the given fnmatch pattern.
+        """
+        if not self.magic.search(pattern):
+            return [pattern] if pattern in self.names else []
+        type_name, _, id_pattern = pattern.partition('/')
+        if self.magic.search(type_name) or not id_pattern:
+            return fnmatch.filter(self.names, pattern)
+        object_ids = self.types.get(type_name, ())
+        prefix = id_pattern[:self.magic.search(id_pattern).start()]
+        start = bisect.bisect_left(object_ids, prefix)
+        end = bisect.bisect_left(object_ids, prefix + '\U0010ffff')
+        return [type_name + '/' + object_id
+            for object_id in fnmatch.filter(object_ids[start:end], id_pattern)
+            # singletons have no object id
+            if object_id]
+
+
 class ObjectManager(object):
 
-    def __init__(self, runtime, tags=None):
+    stages = ('prepare', 'apply')
+
+    def __init__(self, runtime, tags=None, prepare_jobs=10, apply_jobs=10):
         self.runtime = runtime
         self.tags = tags
+        # object name -> future of its generated code-local and code-remote
+        self.code = {}
         self.log = runtime.log
-        self.queue = asyncio.Queue()
+        # number of workers per stage
+        self.jobs = {
+            'prepare': prepare_jobs,
+            'apply': apply_jobs,
+        }
+        # stage -> queue of the objects that are ready for it, most important first
+        self.ready = {stage: asyncio.PriorityQueue() for stage in self.stages}
+        # stage -> names of the objects waiting for their dependencies before it
+        self.waiting = {stage: set() for stage in self.stages}
         self.pending_objects = set()
         self.realized_objects = set()
         self.objects = {}
-        self.events = {
-            'prepare': {},
-            'apply': {},
-        }
+        self.index = ObjectIndex()
         self.dependencies = {}
+        # object name -> names of the objects it is still waiting for
         self.unresolved_dependencies = {}
+        # object name -> names of the objects waiting for it
+        self.dependents = {}
+        # object name -> position in a topological order of the objects
+        self.order = {}
+        # object name -> length of the longest chain of objects waiting for it
+        self.priorities = {}
+        # number of dependencies added since the priorities were computed
+        self.priority_changes = 0
+        # resolved once all objects are realized or with the first error
+        self.done = asyncio.Future(loop=runtime.loop)
         #self.collector = asyncio.ensure_future(self._collect_new_objects())
 
     async def collect_new_objects(self):
         # TODO: make this event based
         # TODO: use unix socket or zmq or something for cdist <-> emulator communication
-        for _object in (await self.runtime.loop.run_in_executor(None, self.runtime.list_objects)):
+        new_objects = await self.runtime.loop.run_in_executor(None, self.runtime.list_new_objects)
+        self.runtime.dependency.update()
+        added = []
+        for _object in new_objects:
             if _object.name not in self.objects:
                 self.add(_object)
+                added.append(_object)
+        return added
 
     def add(self, _object):
         self.log.info('add: %s', _object)
         self.objects[_object.name] = _object
-        self.events['prepare'][_object.name] = asyncio.Event()
-        self.events['apply'][_object.name] = asyncio.Event()
-        self.queue.put_nowait(_object)
+        self.index.add(_object.name)
+        self.order[_object.name] = len(self.order)
+        self.pending_objects.add(_object.name)
+
+    def schedule(self, _object, stage):
+        """Resolve the dependencies of the given object and queue it for the
+        given stage, or keep it waiting until its dependencies are realized.
+        """
+        deps = self.resolve_dependencies(_object)
+        if not self.unresolved_dependencies[_object.name]:
+            self.dispatch(_object.name, stage)
+        elif stage == 'prepare' and not deps['require']:
+            # Objects without 'require' dependencies can be prepared
+            self.dispatch(_object.name, stage)
+        else:
+            self.waiting[stage].add(_object.name)
+
+    def dispatch(self, object_name, stage):
+        self.ready[stage].put_nowait((-self.priority(object_name), self.order[object_name], object_name))
 
     def resolve_dependencies(self, _object):
         self.dependencies.setdefault(_object.name, set())
@@ -65,19 +153,86 @@ class ObjectManager(object):
 
         dependencies = set(self.find_requirements_by_name(deps['require'] + deps['after'] + deps['auto']))
         unresolved_dependencies = dependencies.difference(self.realized_objects)
-        # Objects without any unresolved dependencies can be prepared and applied
-        if len(unresolved_dependencies) == 0:
-            self.events['prepare'][_object.name].set()
-            self.events['apply'][_object.name].set()
-        else:
-            if not deps['require']:
-                # Objects without 'require' dependencies can be prepared
-                self.events['prepare'][_object.name].set()
-            else:
-                self.events['prepare'][_object.name].clear()
-            self.events['apply'][_object.name].clear()
         self.dependencies[_object.name] = dependencies
+        previous = self.unresolved_dependencies[_object.name]
+        for name in previous - unresolved_dependencies:
+            self.dependents[name].discard(_object.name)
+        for name in unresolved_dependencies - previous:
+            self.check_circular_reference(_object.name, name)
+            self.dependents.setdefault(name, set()).add(_object.name)
+            self.priority_changes += 1
         self.unresolved_dependencies[_object.name] = unresolved_dependencies
+        return deps
+
+    def priority(self, object_name):
+        """Return the length of the longest chain of objects that are
+        waiting, directly or indirectly, for the given object.
+
+        Priorities only steer the order in which ready objects are started,
+        so they are recomputed lazily once enough edges have changed to keep
+        the cost linear in the size of the graph.
+        """
+        if self.priority_changes and self.priority_changes >= len(self.order) // 10:
+            self.compute_priorities()
+        return self.priorities.get(object_name, 0)
+
+    def compute_priorities(self):
+        priorities = {}
+        # dependents always come after their dependencies in self.order
+        for name in sorted(self.dependents, key=self.order.get, reverse=True):
+            dependents = self.dependents[name]
+            if dependents:
+                priorities[name] = max(priorities.get(dependent, 0) for dependent in dependents) + 1
+        self.priorities = priorities
+        self.priority_changes = 0
+
+    def check_circular_reference(self, object_name, dependency):
+        """Raise CircularReferenceError if making the given object depend
+        on the given dependency would close a cycle.
+
+        Keeps self.order a topological order of the unresolved dependencies
+        (Pearce and Kelly, 2006), so only edges that go against that order
+        need a search, and only within the range of positions they span.
+        """
+        if dependency == object_name:
+            raise exceptions.CircularReferenceError([object_name, object_name])
+        order = self.order
+        lower = order[object_name]
+        upper = order[dependency]
+        if upper < lower:
+            return
+        # objects waiting for the given object that are ordered before the
+        # dependency, remembering how we got there
+        parents = {object_name: None}
+        stack = [object_name]
+        while stack:
+            current = stack.pop()
+            for dependent in self.dependents.get(current, ()):
+                if dependent == dependency:
+                    path = [object_name, dependency]
+                    while current is not None:
+                        path.append(current)
+                        current = parents[current]
+                    raise exceptions.CircularReferenceError(path)
+                if dependent not in parents and order[dependent] < upper:
+                    parents[dependent] = current
+                    stack.append(dependent)
+        # objects the dependency is waiting for that are ordered after the
+        # given object
+        upstream = {dependency}
+        stack = [dependency]
+        while stack:
+            current = stack.pop()
+            for name in self.unresolved_dependencies.get(current, ()):
+                if name not in upstream and order[name] > lower:
+                    upstream.add(name)
+                    stack.append(name)
+        # move the dependency and what it waits for in front of the given
+        # object and what waits for it, reusing their positions
+        names = sorted(upstream, key=order.get) + sorted(parents, key=order.get)
+        positions = sorted(order[name] for name in names)
+        for name, position in zip(names, positions):
+            order[name] = position
 
 
     def find_requirements_by_name(self, requirements):
@@ -88,62 +243,109 @@ class ObjectManager(object):
         find_requirements_by_name(['__type/object_id', '__other_type/*']) ->
             ['__type/object_id', '__other_type/any', '__other_type/match']
         """
-        object_names = self.objects.keys()
         for pattern in requirements:
-            found = False
-            for requirement in fnmatch.filter(object_names, pattern):
-                found = True
-                yield requirement
+            found = self.index.find(pattern)
             if not found:
                 raise exceptions.RequirementNotFoundError(pattern)
+            yield from found
 
     async def prepare(self, _object):
-        self.resolve_dependencies(_object)
-        event = self.events['prepare'][_object.name]
-        await event.wait()
         self.log.info('prepare: %s', _object)
         await self.runtime.run_type_explorers(_object)
         await self.runtime.run_type_manifest(_object)
-        await self.collect_new_objects()
+        new_objects = await self.collect_new_objects()
+        # Resolve our own dependencies before those of the objects we
+        # created so that they inherit our explicit requirements.
+        self.schedule(_object, 'apply')
+        for new_object in new_objects:
+            self.schedule(new_object, 'prepare')
+        if self.runtime.get_type(_object['type'])['concurrent-gencode']:
+            # overlap code generation with waiting for our dependencies
+            await self.generate_code(_object)
+
+    def generate_code(self, _object):
+        """Return a future for the code-local and code-remote of the given
+        object, running the gencode scripts if they have not been started
+        already.
+
+        gencode-remote usually runs after gencode-local as it may depend on
+        files or messages created by it, and both only run once the
+        object's dependencies are realized. Types which declare
+        'concurrent-gencode' have gencode scripts which depend neither on
+        each other nor on messages from other objects. Their scripts run at
+        the same time, right after the object is prepared.
+        """
+        future = self.code.get(_object.name)
+        if future is None:
+            _type = self.runtime.get_type(_object['type'])
+            if _type['concurrent-gencode']:
+                future = asyncio.gather(
+                    self.runtime.run_gencode_local(_object),
+                    self.runtime.run_gencode_remote(_object),
+                )
+            else:
+                future = asyncio.ensure_future(self._generate_code(_object))
+            self.code[_object.name] = future
+        return future
+
+    async def _generate_code(self, _object):
+        code_local = await self.runtime.run_gencode_local(_object)
+        code_remote = await self.runtime.run_gencode_remote(_object)
+        return code_local, code_remote
 
     async def apply(self, _object):
-        self.resolve_dependencies(_object)
-        event = self.events['apply'][_object.name]
-        await event.wait()
         self.log.info('apply: %s', _object)
-        _object['code-local'] = await self.runtime.run_gencode_local(_object)
-        _object['code-remote'] = await self.runtime.run_gencode_remote(_object)
+        code_local, code_remote = await self.generate_code(_object)
+        del self.code[_object.name]
+        _object['code-local'] = code_local
+        _object['code-remote'] = code_remote
         await self.runtime.sync_object(_object, 'code-local', 'code-remote')
         if _object['code-local']:
             self.log.info('apply code-local: %s', _object)
             await self.runtime.run_code_local(_object)
         if _object['code-remote']:
             self.log.info('apply code-remote: %s', _object)
-            await self.runtime.transfer_code_remote(_object)
-            await self.runtime.run_code_remote(_object)
+            await self.runtime.apply_code_remote(_object)
+        if self.runtime.explorer_cache is not None and (_object['code-local'] or _object['code-remote']):
+            # the code changed the target, what the explorers found is stale
+            self.runtime.explorer_cache.invalidate(_object.name)
         self.finish(_object)
 
     def finish(self, _object):
         self.log.info('finish: %s', _object)
-        for object_name, dependencies in self.unresolved_dependencies.items():
-            if _object.name in dependencies:
-                dependencies.remove(_object.name)
-                if len(dependencies) == 0:
-                    self.events['prepare'][object_name].set()
-                    self.events['apply'][object_name].set()
-        self.queue.task_done()
+        for object_name in self.dependents.pop(_object.name, ()):
+            dependencies = self.unresolved_dependencies[object_name]
+            dependencies.remove(_object.name)
+            if len(dependencies) == 0:
+                for stage in self.stages:
+                    if object_name in self.waiting[stage]:
+                        self.waiting[stage].remove(object_name)
+                        self.dispatch(object_name, stage)
         self.pending_objects.remove(_object.name)
         self.realized_objects.add(_object.name)
+        if not self.pending_objects and not self.done.done():
+            self.done.set_result(None)
 
-    async def realize(self, _object):
-        self.log.info('realize: %s', _object)
-        self.pending_objects.add(_object.name)
-        await self.prepare(_object)
-        await self.apply(_object)
+    async def worker(self, stage):
+        """Run the given stage for one ready object after the other, those
+        at the start of the longest chains first.
+        """
+        queue = self.ready[stage]
+        run = getattr(self, stage)
+        while True:
+            unused_priority, unused_order, object_name = await queue.get()
+            try:
+                await run(self.objects[object_name])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if not self.done.done():
+                    self.done.set_exception(e)
 
     async def print_info(self):
         while True:
-            print('### queue: %s' % self.queue, flush=True)
+            for stage in self.stages:
+                print('### %s: ready: %d waiting: %d' % (stage, self.ready[stage].qsize(), len(self.waiting[stage])), flush=True)
             print('### pending_objects: %s' % self.pending_objects, flush=True)
             print('### realized_objects: %s' % self.realized_objects, flush=True)
             unresolved_dependencies = {}
@@ -156,19 +358,21 @@ class ObjectManager(object):
             #print('### unresolved_dependencies: %s' % unresolved_dependencies, flush=True)
             await asyncio.sleep(3)
 
-    async def realize_objects(self):
-        tasks = []
-        while True:
-            _object = await self.queue.get()
-            task = asyncio.ensure_future(self.realize(_object))
-            tasks.append(task)
-
     async def process(self):
         _print_info_task = None
         #_print_info_task = asyncio.ensure_future(self.print_info())
-        await self.collect_new_objects()
-        realize_task = asyncio.ensure_future(self.realize_objects())
-        await self.queue.join()
-        realize_task.cancel()
-        if _print_info_task:
-            _print_info_task.cancel()
+        for _object in await self.collect_new_objects():
+            self.schedule(_object, 'prepare')
+        if not self.pending_objects:
+            return
+        workers = [asyncio.ensure_future(self.worker(stage))
+            for stage in self.stages
+            for i in range(self.jobs[stage])]
+        try:
+            # raises the first error
+            await self.done
+        finally:
+            for worker in workers:
+                worker.cancel()
+            if _print_info_task:
+                _print_info_task.cancel()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+#
+# 2015 Steven Armstrong (steven-cdist at armstrong.cc)
+#
+# This file is part of cdist.
+#
+# cdist is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cdist is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cdist. If not, see <http://www.gnu.org/licenses/>.
+#
+#
+
+"""Minimal request/response protocol over unix sockets between the running
+cdist process and the processes it spawns, e.g. the type emulator.
+
+A message consists of a json header and an opaque binary payload, each
+prefixed with its length as a 4 byte big endian integer.
+
+Only depends on the standard library so that clients start quickly.
+"""
+
+import json
+import socket
+import struct
+
+
+_length = struct.Struct('!I')
+
+
+def pack(header, payload=b''):
+    """Return the given header and payload as a message."""
+    data = json.dumps(header).encode()
+    return b''.join((_length.pack(len(data)), data, _length.pack(len(payload)), payload))
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 65536))
+        if not chunk:
+            raise EOFError('connection closed')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def receive(sock):
+    """Receive a message from the given socket and return a tuple of its
+    header and payload.
+    """
+    size, = _length.unpack(_recv_exactly(sock, _length.size))
+    header = json.loads(_recv_exactly(sock, size).decode())
+    size, = _length.unpack(_recv_exactly(sock, _length.size))
+    payload = _recv_exactly(sock, size)
+    return header, payload
+
+
+async def read(reader):
+    """Read a message from the given asyncio StreamReader and return a tuple
+    of its header and payload.
+    """
+    size, = _length.unpack(await reader.readexactly(_length.size))
+    header = json.loads((await reader.readexactly(size)).decode())
+    size, = _length.unpack(await reader.readexactly(_length.size))
+    payload = await reader.readexactly(size)
+    return header, payload
+
+
+def write(writer, header, payload=b''):
+    """Write a message to the given asyncio StreamWriter."""
+    writer.write(pack(header, payload))
+
+
+def call(path, header, payload=b''):
+    """Send a request to the server listening on the unix socket at path and
+    return a tuple of the header and payload of its response.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        sock.sendall(pack(header, payload))
+        return receive(sock)
+    finally:
+        sock.close()
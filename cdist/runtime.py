@@ -1,5 +1,10 @@
 import os
+import io
 import glob
+import shlex
+import hashlib
+import subprocess
+import collections
 import asyncio
 import contextlib
 import tempfile
@@ -9,9 +14,15 @@ import logging
 
 
 from .execution import Local, Remote
+from . import execution
+from .batch import Batch
 from .core import CdistType, CdistObject
 from . import dependency
 from . import manager
+from .journal import Journal
+from .type_cache import TypeCache
+from . import rpc
+from . import emulator
 
 
 class Runtime(object):
@@ -22,23 +33,52 @@ class Runtime(object):
     OBJECT_PREPARED = 'prepared'
     OBJECT_DONE = 'done'
 
-    def __init__(self, target, local_session_dir, remote_session_dir, tags=None, logger=None, loop=None):
+    def __init__(self, target, local_session_dir, remote_session_dir, tags=None, logger=None, loop=None,
+            persistent_shell=False, limits=None, budget=None, emulator_server=True,
+            batch_code_remote=False, batch_explorers=False, explorer_cache=None,
+            prepare_jobs=None, apply_jobs=None, sync_conf=False):
         self.target = target
         self.local_session_dir = local_session_dir
         self.remote_session_dir = remote_session_dir
         self.tags = tags
+        self.persistent_shell = persistent_shell
+        # number of objects prepared and applied at the same time
+        self.prepare_jobs = prepare_jobs
+        self.apply_jobs = apply_jobs
+        # keep conf directories on the target between runs, see execution.Remote.sync
+        self.sync_conf = sync_conf
+        # default concurrency limits for the target, see execution.Remote
+        self.limits = limits or {}
+        # session wide process limits shared with other runtimes,
+        # see scheduler.ProcessBudget
+        self.budget = budget
+        self.emulator_server = emulator_server
+        self.__emulator_server = None
         self.log = logger or logging.getLogger('cdist')
         self.loop = loop or asyncio.get_event_loop()
         self.__path = None
         self.__environ = None
         self.__dependency = None
+        self.__object_journal = None
         self.__object_cache = {}
         self.__type_cache = {}
+        self.__compiled_types = None
         self._type_explorers_transferred = {}
         self.__target_lock = asyncio.Lock()
+        # emulator requests are handled one at a time, see _handle_emulator_request
+        self.__emulator_lock = asyncio.Lock()
 
         self.local = Local(self)
         self.remote = Remote(self)
+        self.object_store = ObjectStore(self)
+        self.code_remote_batch = None
+        if batch_code_remote:
+            self.code_remote_batch = CodeRemoteBatch(self)
+        # results of explorers from previous runs, see explorer_cache.ExplorerCache
+        self.explorer_cache = explorer_cache
+        self.explorer_batch = None
+        if batch_explorers:
+            self.explorer_batch = ExplorerBatch(self)
 
     def __repr__(self):
         return '<Runtime %s>' % self.target['url']
@@ -61,6 +101,9 @@ class Runtime(object):
                 },
                 'local': {
                     'bin': opj(self.local_session_dir, 'bin'),
+                    # keep it short, unix socket paths are limited to ~100 characters
+                    'emulator-socket': opj(self.local_session_dir, 'sockets',
+                        hashlib.md5(self.target.identifier.encode()).hexdigest()[:16]),
                     'explorer': opj(self.local_session_dir, 'conf', 'explorer'),
                     'global': target_path,
                     'initial-manifest': opj(self.local_session_dir, 'manifest'),
@@ -69,6 +112,7 @@ class Runtime(object):
                     'session': self.local_session_dir,
                     'target': target_path,
                     'type': opj(self.local_session_dir, 'conf', 'type'),
+                    'type-cache': opj(self.local_session_dir, 'type-cache.json'),
                 },
                 'remote': {
                     'conf': opj(self.remote_session_dir, 'conf'),
@@ -108,6 +152,17 @@ class Runtime(object):
             ))
         return self.__dependency
 
+    @property
+    def object_journal(self):
+        """Lazy initialized journal of the names of created objects.
+        """
+        if self.__object_journal is None:
+            self.__object_journal = Journal(os.path.join(
+                self.path['local']['target'],
+                'object-journal'
+            ))
+        return self.__object_journal
+
     def get_dependencies(self, object_or_name):
         """Get a objects dependencies by name or object.
         """
@@ -132,21 +187,24 @@ class Runtime(object):
         object_path = self.get_object_path(cdist_object, 'local')
         os.makedirs(object_path)
         cdist_object.to_dir(object_path)
+        self.object_journal.append(cdist_object.name)
 
     def blocking_sync_object(self, cdist_object, *keys):
         """Sync changes to the cdist object to disk.
+
+        Only the given keys, or all if none are given, which changed since
+        the object was last synced are written.
         """
         object_path = self.get_object_path(cdist_object, 'local')
-        cdist_object.to_dir(object_path, keys=keys)
+        cdist_object.store(object_path, keys=keys or None)
 
     async def sync_object(self, cdist_object, *keys):
         """Sync changes to the cdist object to disk.
+
+        Syncs requested while a previous batch is being written are
+        coalesced per object and written together, see `ObjectStore`.
         """
-        # FIXME: do I need to synchronize here?
-        args = [cdist_object]
-        args.extend(keys)
-        await self.loop.run_in_executor(None, self.blocking_sync_object, *args)
-        #self.loop.call_soon_threadsafe(self.loop.run_in_executor, None, self.blocking_sync_object, *args)
+        await self.object_store.submit((cdist_object, keys or None))
 
     def get_type_path(self, type_or_name, context, component=None):
         """Get the absolute path to a type by name or instance.
@@ -160,12 +218,25 @@ class Runtime(object):
             parts.append(component)
         return os.path.join(*parts)
 
+    @property
+    def compiled_types(self):
+        """Lazy initialized types precompiled by the session.
+        """
+        if self.__compiled_types is None:
+            self.__compiled_types = TypeCache(self.path['local']['type-cache'])
+        return self.__compiled_types
+
     def get_type(self, type_name):
         """Get a type instance by name.
+
+        Types are taken from the types precompiled by the session if
+        possible, see type_cache.TypeCache.
         """
         if type_name not in self.__type_cache:
-            type_path = self.get_type_path(type_name, 'local')
-            _type = CdistType.from_dir(type_path)
+            _type = self.compiled_types.get(type_name)
+            if _type is None:
+                type_path = self.get_type_path(type_name, 'local')
+                _type = CdistType.from_dir(type_path)
             self.__type_cache[type_name] = _type
         return self.__type_cache[type_name]
 
@@ -188,7 +259,7 @@ class Runtime(object):
             type_name, object_id = CdistObject.split_name(object_name)
             object_path = self.get_object_path(object_name, 'local')
             _type = self.get_type(type_name)
-            _object = _type.object_from_dir(object_path)
+            _object = _type.object_from_dir(object_path, object_id=object_id)
             self.__object_cache[object_name] = _object
         return self.__object_cache[object_name]
 
@@ -212,38 +283,133 @@ class Runtime(object):
             _object = self.get_object(object_name)
             yield _object
 
+    def list_new_objects(self):
+        """Return a list of the object instances that were created since the
+        last call to this method.
+        """
+        return [self.get_object(object_name)
+            for object_name in self.object_journal.read()]
+
     async def initialize(self):
         """Initialize this runtime.
         """
         # Setup file permissions using umask
         os.umask(0o077)
 
+        if self.persistent_shell:
+            await self.remote.start_shell()
+        if self.emulator_server:
+            await self.start_emulator_server()
+
         # Create remote-session-dir with sane permissions
-        await self.remote.mkdir(self.path['remote']['session'])
-        await self.remote.check_call(['chmod', '0700', self.path['remote']['session']])
-        await self.remote.mkdir(self.path['remote']['conf'])
-        await self.remote.mkdir(self.path['remote']['object'])
+        rsp = self.path['remote']
+        await self.prepare_remote(
+            ('mkdir', rsp['session']),
+            ('chmod', '0700', rsp['session']),
+            ('mkdir', rsp['conf']),
+            ('mkdir', rsp['object']),
+        )
+
+    async def prepare_remote(self, *operations):
+        """Run the given filesystem operations on the target in one go and
+        wait for them to complete.
+
+        prepare_remote(('mkdir', path), ('chmod', '0700', path))
+        """
+        futures = [self.remote.enqueue(*operation) for operation in operations]
+        await asyncio.gather(*futures)
 
     async def process_objects(self):
         """Process all objects.
         """
-        om = manager.ObjectManager(self, tags=self.tags)
+        # the number of workers for each stage can be overridden per target
+        options = self.target.options
+        om = manager.ObjectManager(self, tags=self.tags,
+            prepare_jobs=int(options.get('prepare-jobs') or self.prepare_jobs or 10),
+            apply_jobs=int(options.get('apply-jobs') or self.apply_jobs or 10),
+        )
         await om.process()
 
     async def finalize(self):
         """Finalize and cleanup this runtime.
         """
         await self.sync_target()
+        if self.explorer_cache is not None:
+            self.explorer_cache.save()
+        await self.cleanup()
+
+    async def cleanup(self):
+        """Stop the persistent shell and the emulator server if they are
+        running. Safe to call more than once, also after a failure.
+        """
+        await self.remote.stop_shell()
+        await self.stop_emulator_server()
+
+    async def start_emulator_server(self):
+        """Listen on a unix socket for requests from the type emulator so
+        that objects are created in this process instead of by a new cdist
+        process for each object.
+        """
+        path = self.path['local']['emulator-socket']
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.__emulator_server = await asyncio.start_unix_server(
+            self._handle_emulator_request, path=path, loop=self.loop)
+
+    async def stop_emulator_server(self):
+        """Stop listening for requests from the type emulator.
+        """
+        if self.__emulator_server is not None:
+            server, self.__emulator_server = self.__emulator_server, None
+            server.close()
+            await server.wait_closed()
+            os.remove(self.path['local']['emulator-socket'])
+
+    async def _handle_emulator_request(self, reader, writer):
+        """Create the object requested by the type emulator.
+
+        The object is created on the executor as that does blocking file
+        I/O. Requests are handled one after the other like they were when
+        every emulator created its object itself.
+        """
+        try:
+            request, payload = await rpc.read(reader)
+        except asyncio.IncompleteReadError as e:
+            self.log.debug('emulator request: incomplete request: %s', e)
+            writer.close()
+            return
+        try:
+            self.log.debug('emulator request: %s %s', request['type'], request['args'])
+            stdin = io.BytesIO(payload) if request['stdin'] else None
+            callback = functools.partial(emulator.emulate, self.log, self, request['type'], request['args'],
+                environ=request['environ'], stdin=stdin)
+            with (await self.__emulator_lock):
+                exit_code, error = await self.loop.run_in_executor(None, callback)
+        except Exception as e:
+            self.log.exception('emulator request failed: %s %s', request.get('type'), request.get('args'))
+            exit_code, error = 1, 'Failed to create object: %s' % e
+        try:
+            rpc.write(writer, {'exit-code': exit_code, 'error': error})
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def transfer_conf(self, source, destination):
+        """Transfer a directory from the conf dir to the target, only sending
+        what changed since the last run if enabled.
+        """
+        if self.remote.sync_conf:
+            await self.remote.sync(source, destination)
+        else:
+            await self.remote.transfer(source, destination)
 
     async def transfer_global_explorers(self):
         """Transfer the global explorers to the target.
         """
-        await self.remote.transfer(
+        await self.transfer_conf(
             self.path['local']['explorer'],
             self.path['remote']['explorer']
         )
-        await self.remote.check_call(
-            ['chmod', '0700', '%s/*' % self.path['remote']['explorer']])
+        await self.remote.chmod('0700', '%s/*' % self.path['remote']['explorer'])
 
     async def run_global_explorer(self, name):
         """Run the given global explorer and return it's output.
@@ -260,38 +426,56 @@ class Runtime(object):
         """Run all global explorers and save their output in the session.
         """
         self.log.debug('Running global explorers')
-        await self.transfer_global_explorers()
-        # execute explorers in parallel
-        tasks = []
         if not explorer_names:
             explorer_names = glob.glob1(self.path['local']['explorer'], '*')
+        cache = self.explorer_cache
+        missing = []
         for name in explorer_names:
-            task = self.loop.create_task(self.run_global_explorer(name))
-            task.name = name
-            tasks.append(task)
-        if tasks:
+            value = None
+            if cache is not None:
+                value = cache.get(name, os.path.join(self.path['local']['explorer'], name))
+            if value is None:
+                missing.append(name)
+            else:
+                self.target['explorer'][name] = value
+        # type explorers may call global explorers, so transfer them even
+        # if all their results are cached
+        await self.transfer_global_explorers()
+        if missing:
+            # execute explorers in parallel
+            tasks = []
+            for name in missing:
+                task = self.loop.create_task(self.run_global_explorer(name))
+                task.name = name
+                tasks.append(task)
             results = await asyncio.gather(*tasks)
-            for index,name in enumerate(explorer_names):
+            for index,name in enumerate(missing):
                 self.target['explorer'][name] = results[index]
+                if cache is not None:
+                    cache.set(name, os.path.join(self.path['local']['explorer'], name), results[index])
+        if explorer_names:
             await self.sync_target('explorer')
 
-    async def run_type_explorer(self, cdist_object, explorer_name):
-        """Run the given type explorer for the given object and return it's output.
+    def type_explorer_environ(self, cdist_object):
+        """Return the environment for the type explorers of the given object.
         """
-        remote_explorer_path = self.get_type_path(cdist_object['type'], 'remote', 'explorer')
-
         env = {
             '__object': self.get_object_path(cdist_object, 'remote'),
             '__object_name': cdist_object.name,
-            '__type_explorer': remote_explorer_path,
+            '__type_explorer': self.get_type_path(cdist_object['type'], 'remote', 'explorer'),
             '__explorer': self.path['remote']['explorer'],
         }
         _type = self.get_type(cdist_object['type'])
         if not _type['singleton']:
             env['__object_id'] = cdist_object['object-id']
+        return env
 
+    async def run_type_explorer(self, cdist_object, explorer_name):
+        """Run the given type explorer for the given object and return it's output.
+        """
+        env = self.type_explorer_environ(cdist_object)
         self.log.debug("Running type explorer '%s' for object %s", explorer_name, cdist_object)
-        explorer = os.path.join(remote_explorer_path, explorer_name)
+        explorer = os.path.join(env['__type_explorer'], explorer_name)
         result = await self.remote.check_output([explorer], env=env)
         return result.decode('ascii').rstrip()
 
@@ -299,25 +483,55 @@ class Runtime(object):
         """Run all type explorers for the given object and save their output in
         the object.
         """
-        cdist_type = self.get_type(cdist_object['type'])
-        if not cdist_type.name in self._type_explorers_transferred:
-            self._type_explorers_transferred[cdist_type.name] = asyncio.Event()
-            await self.transfer_type_explorers(cdist_type)
-        await self._type_explorers_transferred[cdist_type.name].wait()
+        explorer_names = list(cdist_object['explorer'])
+        cache = self.explorer_cache
+        missing = []
+        for name in explorer_names:
+            value = None
+            if cache is not None:
+                value = cache.get(*self.type_explorer_cache_key(cdist_object, name))
+            if value is None:
+                missing.append(name)
+            else:
+                cdist_object['explorer'][name] = value
+
+        # code-remote may read the parameters even if no explorer is run
         await self.transfer_object_parameters(cdist_object)
-
-        # execute explorers in parallel
-        tasks = []
-        for name in cdist_object['explorer']:
-            task = self.loop.create_task(self.run_type_explorer(cdist_object, name))
-            task.name = name
-            tasks.append(task)
-        if tasks:
-            results = await asyncio.gather(*tasks)
-            for index,name in enumerate(cdist_object['explorer']):
+        if missing:
+            cdist_type = self.get_type(cdist_object['type'])
+            if not cdist_type.name in self._type_explorers_transferred:
+                self._type_explorers_transferred[cdist_type.name] = asyncio.Event()
+                await self.transfer_type_explorers(cdist_type)
+            await self._type_explorers_transferred[cdist_type.name].wait()
+
+            if self.explorer_batch is not None:
+                # execute explorers in a shell shared with other objects
+                results = await self.explorer_batch.submit((cdist_object, missing))
+            else:
+                # execute explorers in parallel
+                tasks = []
+                for name in missing:
+                    task = self.loop.create_task(self.run_type_explorer(cdist_object, name))
+                    task.name = name
+                    tasks.append(task)
+                results = await asyncio.gather(*tasks)
+            for index,name in enumerate(missing):
                 cdist_object['explorer'][name] = results[index]
+                if cache is not None:
+                    explorer, script, object_name, parameters = self.type_explorer_cache_key(cdist_object, name)
+                    cache.set(explorer, script, results[index], object_name, parameters)
+        if explorer_names:
             await self.sync_object(cdist_object, 'explorer')
 
+    def type_explorer_cache_key(self, cdist_object, explorer_name):
+        """Return the explorer name, script path, object name and parameters
+        identifying the result of the given type explorer in the explorer cache.
+        """
+        type_name = cdist_object['type']
+        script = os.path.join(self.get_type_path(type_name, 'local', 'explorer'), explorer_name)
+        explorer = '%s/%s' % (type_name, explorer_name)
+        return explorer, script, cdist_object.name, cdist_object['parameter']
+
     async def transfer_type_explorers(self, cdist_type):
         """Transfer the type explorers for the given type to the target.
         """
@@ -325,9 +539,8 @@ class Runtime(object):
             self.log.debug("Transfering type explorers for type: %s", cdist_type)
             source = self.get_type_path(cdist_type, 'local', 'explorer')
             destination = self.get_type_path(cdist_type, 'remote', 'explorer')
-            await self.remote.transfer(source, destination)
-            await self.remote.check_call(
-                ['chmod', '0700', '%s/*' % destination])
+            await self.transfer_conf(source, destination)
+            await self.remote.chmod('0700', '%s/*' % destination)
         self._type_explorers_transferred[cdist_type.name].set()
 
     async def transfer_object_parameters(self, cdist_object):
@@ -455,18 +668,22 @@ class Runtime(object):
         destination_dir = os.path.dirname(destination)
         await self.remote.mkdir(destination_dir)
         await self.remote.transfer(source, destination)
-        await self.remote.check_call(['chmod', '0700', destination])
+        await self.remote.chmod('0700', destination)
 
-    async def _run_code(self, cdist_object, context):
-        """Run the code-* script for the given object.
+    def code_environ(self, cdist_object, context):
+        """Return the environment for the code-* script of the given object.
         """
-        script = self.get_object_path(cdist_object, context, 'code-%s' % context)
-
-        env = {
+        return {
             '__object': self.get_object_path(cdist_object, context),
             '__object_id': cdist_object['object-id'],
             '__object_name': cdist_object.name,
         }
+
+    async def _run_code(self, cdist_object, context):
+        """Run the code-* script for the given object.
+        """
+        script = self.get_object_path(cdist_object, context, 'code-%s' % context)
+        env = self.code_environ(cdist_object, context)
         self.log.debug("Running code-%s for object %s", context, cdist_object)
         _context = getattr(self, context)
         return await _context.check_call([script], env=env, shell=True)
@@ -481,3 +698,161 @@ class Runtime(object):
         """
         return await self._run_code(cdist_object, 'remote')
 
+    async def apply_code_remote(self, cdist_object):
+        """Transfer the code-remote script for the given object to the target
+        and run it there.
+
+        If batching is enabled, this is done together with all other objects
+        whose code-remote is ready at the same time.
+        """
+        if self.code_remote_batch is not None:
+            await self.code_remote_batch.submit(cdist_object)
+        else:
+            await self.transfer_code_remote(cdist_object)
+            await self.run_code_remote(cdist_object)
+
+
+class CodeRemoteBatch(Batch):
+    """Transfers and runs the code-remote scripts of a wave of objects with
+    one transfer and one remote shell.
+
+    Objects in a wave were ready at the same time, so none of them depends
+    on another one. Their scripts are run one after the other in the order
+    they were submitted. The output of the scripts is sent to stderr, stdout
+    carries the exit status of each of them. The batch itself is fed to the
+    remote shell on stdin, so the scripts get /dev/null as their stdin.
+    """
+    serial = True
+
+    def __init__(self, runtime):
+        super().__init__(loop=runtime.loop)
+        self.runtime = runtime
+
+    def script(self, cdist_objects):
+        shell = os.environ.get('CDIST_REMOTE_SHELL', '/bin/sh')
+        paths = []
+        lines = []
+        for index, cdist_object in enumerate(cdist_objects):
+            path = self.runtime.get_object_path(cdist_object, 'remote', 'code-remote')
+            paths.append(shlex.quote(path))
+            env = self.runtime.code_environ(cdist_object, 'remote')
+            words = ['%s=%s' % (key, shlex.quote(value)) for key, value in sorted(env.items())]
+            words.extend([shell, '-e', shlex.quote(path), '< /dev/null', '>&2'])
+            lines.append(' '.join(words))
+            lines.append('printf \'%%s %%s\\n\' %d "$?"' % index)
+        return 'chmod 0700 %s\n%s\n' % (' '.join(paths), '\n'.join(lines))
+
+    async def process(self, cdist_objects):
+        mapping = {
+            self.runtime.get_object_path(cdist_object, 'local', 'code-remote'):
+                self.runtime.get_object_path(cdist_object, 'remote', 'code-remote')
+            for cdist_object in cdist_objects
+        }
+        await asyncio.gather(*[self.runtime.remote.mkdir(os.path.dirname(destination))
+            for destination in mapping.values()])
+        await self.runtime.remote.transfer_many(mapping)
+        script = self.script(cdist_objects)
+        self.runtime.log.debug('Running code-remote for %d objects:\n%s', len(cdist_objects), script)
+        output = await self.runtime.remote.check_output(['/bin/sh'], input=script.encode())
+        return execution.parse_status(output,
+            [[self.runtime.get_object_path(cdist_object, 'remote', 'code-remote')]
+                for cdist_object in cdist_objects])
+
+
+class ExplorerBatch(Batch):
+    """Runs the type explorers submitted as tuples of an object and the
+    names of its explorers during one iteration of the event loop in a
+    single remote shell.
+
+    The output of each explorer is written to stdout as a frame of the form
+
+        <object index> <explorer index> <exit status> <length>\n<output>
+
+    and split back into the results for each object. The batch itself is
+    fed to the remote shell on stdin, so explorers get /dev/null as their
+    stdin.
+    """
+
+    prelude = execution.private_tmp_script('cdist-explorer') + """__cdist_out="$__cdist_tmp/out"
+__cdist_frame() {
+   printf '%s %s %s %s\\n' "$1" "$2" "$3" "$(wc -c < "$__cdist_out" | tr -d ' ')"
+   cat "$__cdist_out"
+}
+"""
+
+    def __init__(self, runtime):
+        super().__init__(loop=runtime.loop)
+        self.runtime = runtime
+
+    def script(self, items):
+        lines = [self.prelude]
+        for object_index, (cdist_object, explorer_names) in enumerate(items):
+            env = self.runtime.type_explorer_environ(cdist_object)
+            words = ['%s=%s' % (key, shlex.quote(value)) for key, value in sorted(env.items())]
+            for explorer_index, name in enumerate(explorer_names):
+                explorer = shlex.quote(os.path.join(env['__type_explorer'], name))
+                lines.append('%s %s < /dev/null > "$__cdist_out"' % (' '.join(words), explorer))
+                lines.append('__cdist_frame %d %d "$?"' % (object_index, explorer_index))
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def frames(output):
+        """Yield a tuple of object index, explorer index, exit status and
+        output for each frame in the given output.
+        """
+        position = 0
+        while position < len(output):
+            end = output.index(b'\n', position)
+            object_index, explorer_index, returncode, length = map(int, output[position:end].split())
+            position = end + 1 + length
+            yield object_index, explorer_index, returncode, output[end + 1:position]
+
+    async def process(self, items):
+        script = self.script(items)
+        self.runtime.log.debug('Running type explorers for %d objects', len(items))
+        output = await self.runtime.remote.check_output(['/bin/sh'], input=script.encode())
+        results = [[None] * len(explorer_names) for cdist_object, explorer_names in items]
+        errors = {}
+        for object_index, explorer_index, returncode, data in self.frames(output):
+            if returncode:
+                cdist_object, explorer_names = items[object_index]
+                name = explorer_names[explorer_index]
+                path = self.runtime.get_type_path(cdist_object['type'], 'remote', 'explorer')
+                errors[object_index] = subprocess.CalledProcessError(
+                    returncode, [os.path.join(path, name)], output=data)
+            else:
+                results[object_index][explorer_index] = data.decode('ascii').rstrip()
+        for object_index, values in enumerate(results):
+            if None in values and object_index not in errors:
+                # the shell died before running all explorers
+                errors[object_index] = subprocess.CalledProcessError(255, ['/bin/sh'], output=output)
+        return [errors.get(index, values) for index, values in enumerate(results)]
+
+
+class ObjectStore(Batch):
+    """Writes the changes to cdist objects to disk in the background, one
+    batch at a time.
+
+    Items are tuples of an object and the keys to sync, None for all of
+    them. Multiple syncs of the same object are merged and the whole batch
+    is written with a single job on the executor.
+    """
+    serial = True
+
+    def __init__(self, runtime):
+        super().__init__(loop=runtime.loop)
+        self.runtime = runtime
+
+    def write(self, pending):
+        for cdist_object, keys in pending:
+            self.runtime.blocking_sync_object(cdist_object, *(keys or ()))
+
+    async def process(self, items):
+        pending = collections.OrderedDict()
+        for cdist_object, keys in items:
+            if cdist_object.name in pending:
+                previous = pending[cdist_object.name][1]
+                keys = None if keys is None or previous is None else tuple(set(previous) | set(keys))
+            pending[cdist_object.name] = (cdist_object, keys)
+        await self.runtime.loop.run_in_executor(None, self.write, list(pending.values()))
+        return [None] * len(items)
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+#
+# 2015 Steven Armstrong (steven-cdist at armstrong.cc)
+#
+# This file is part of cdist.
+#
+# cdist is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cdist is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cdist. If not, see <http://www.gnu.org/licenses/>.
+#
+#
+
+import time
+import asyncio
+import collections
+import contextlib
+import logging
+log = logging.getLogger(__name__)
+
+
+class FairSemaphore(object):
+    """A semaphore shared by many clients which hands out free slots round
+    robin between the clients that are waiting for one, so that a single
+    client can not starve the others.
+
+    A limit of None means unlimited.
+
+    Usage:
+
+    semaphore = FairSemaphore(10)
+    with (await semaphore(client)):
+        ...
+    """
+
+    def __init__(self, limit=None, loop=None):
+        self.limit = limit
+        self.loop = loop or asyncio.get_event_loop()
+        self.active = 0
+        # client -> deque of waiting futures, in round robin order
+        self.waiters = collections.OrderedDict()
+
+    def __repr__(self):
+        return '<FairSemaphore limit:%s active:%d clients waiting:%d>' % (
+            self.limit, self.active, len(self.waiters))
+
+    def __call__(self, client):
+        return _Slot(self, client)
+
+    def locked(self):
+        return self.limit is not None and self.active >= self.limit
+
+    async def acquire(self, client):
+        if not self.locked() and not self.waiters:
+            self.active += 1
+            return True
+        waiter = asyncio.Future(loop=self.loop)
+        self.waiters.setdefault(client, collections.deque()).append(waiter)
+        try:
+            # the slot is handed over to us by `release`
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            else:
+                queue = self.waiters.get(client)
+                if queue is not None and waiter in queue:
+                    queue.remove(waiter)
+                    if not queue:
+                        del self.waiters[client]
+            raise
+        return True
+
+    def release(self):
+        while self.waiters:
+            # take the next client in line and move it to the end of the line
+            client, queue = self.waiters.popitem(last=False)
+            waiter = queue.popleft()
+            if queue:
+                self.waiters[client] = queue
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+
+class _Slot(object):
+    def __init__(self, semaphore, client):
+        self.semaphore = semaphore
+        self.client = client
+
+    def __await__(self):
+        yield from self.semaphore.acquire(self.client).__await__()
+        return contextlib.closing(self)
+
+    def close(self):
+        self.semaphore.release()
+
+
+class ProcessBudget(object):
+    """Session wide limits on the number of local and remote processes that
+    are run at the same time over all targets.
+    """
+
+    def __init__(self, local=None, remote=None, loop=None):
+        self.local = FairSemaphore(local, loop=loop)
+        self.remote = FairSemaphore(remote, loop=loop)
+
+    def __repr__(self):
+        return '<ProcessBudget local:%s remote:%s>' % (self.local, self.remote)
+
+
+Result = collections.namedtuple('Result', ('item', 'duration', 'error'))
+
+
+class WorkerPool(object):
+    """Runs a coroutine function for each item of a list with at most `jobs`
+    of them in flight, starting the next one as soon as one finishes.
+
+    A `jobs` of None runs all of them at once.
+
+    Usage:
+
+    pool = WorkerPool(jobs=4)
+    results = await pool.run(configure_target, runtimes)
+    for result in results:
+        print(result.item, result.duration, result.error)
+    """
+
+    def __init__(self, jobs=None, loop=None):
+        self.jobs = jobs
+        self.loop = loop or asyncio.get_event_loop()
+
+    async def worker(self, func, queue, results):
+        while not queue.empty():
+            index, item = queue.get_nowait()
+            started = time.time()
+            error = None
+            try:
+                await func(item)
+            except Exception as e:
+                log.debug('worker: %s failed: %s', item, e)
+                error = e
+            results[index] = Result(item, time.time() - started, error)
+
+    async def run(self, func, items):
+        """Run func for all items and return a list of `Result`s in the same
+        order as the items.
+        """
+        queue = asyncio.Queue(loop=self.loop)
+        for index, item in enumerate(items):
+            queue.put_nowait((index, item))
+        results = [None] * len(items)
+        jobs = min(self.jobs or len(items), len(items))
+        workers = [asyncio.ensure_future(self.worker(func, queue, results), loop=self.loop)
+            for i in range(jobs)]
+        if workers:
+            await asyncio.gather(*workers)
+        return results
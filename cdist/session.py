@@ -23,13 +23,19 @@ import sys
 import os
 import urllib
 import time
+import json
+import shutil
 import socket
+import hashlib
+import tempfile
 import logging
 log = logging.getLogger(__name__)
 
 import cconfig
 
 import cdist.target
+from cdist.type_cache import TypeCache
+from cdist.cache import cache_dir
 
 
 class ListOfSymlinkTargets(cconfig.schema.CconfigType):
@@ -42,21 +48,18 @@ class ListOfSymlinkTargets(cconfig.schema.CconfigType):
         _list = []
         try:
             for item in os.listdir(path):
-                _list.append(os.readlink(item))
+                _list.append(os.readlink(os.path.join(path, item)))
         except EnvironmentError:
             pass
         finally:
             return _list
 
     def to_path(self, path, _list):
-        cwd = os.getcwd()
         if not os.path.isdir(path):
             os.mkdir(path)
-        os.chdir(path)
         for source in _list:
-            destination = os.path.basename(source)
+            destination = os.path.join(path, os.path.basename(source))
             os.symlink(source, destination)
-        os.chdir(cwd)
 
 
 class MappingOfSymlinkTargets(cconfig.schema.CconfigType):
@@ -66,28 +69,23 @@ class MappingOfSymlinkTargets(cconfig.schema.CconfigType):
         return {}
 
     def from_path(self, path):
-        cwd = os.getcwd()
         mapping = {}
         try:
-            os.chdir(path)
             for key in os.listdir(path):
-                mapping[key] = os.readlink(key)
+                mapping[key] = os.readlink(os.path.join(path, key))
         except EnvironmentError:
             pass
         finally:
-            os.chdir(cwd)
             return mapping
 
     def to_path(self, path, mapping):
-        cwd = os.getcwd()
         if not os.path.isdir(path):
             os.mkdir(path)
-        os.chdir(path)
         for key, link in mapping.items():
-            if os.path.islink(key):
-                os.unlink(key)
-            os.symlink(link, key)
-        os.chdir(cwd)
+            destination = os.path.join(path, key)
+            if os.path.islink(destination):
+                os.unlink(destination)
+            os.symlink(link, destination)
 
 
 class Session(dict):
@@ -114,6 +112,10 @@ class Session(dict):
     )
     schema = cconfig.Schema(schema_decl)
 
+    # keys which only depend on the conf dirs and are shared between
+    # sessions, see template_dir
+    template_keys = ('bin', 'conf')
+
     @classmethod
     def from_dir(cls, path):
         """Creates a cdist session instance from an existing
@@ -139,7 +141,21 @@ class Session(dict):
             with open(self['conf']['manifest']['init'], 'r') as fd:
                 self['manifest'] = fd.read()
 
-        cconfig.to_dir(path, self, schema=self.schema)
+        keys = [key for key in self if key not in self.template_keys]
+        cconfig.to_dir(path, self, schema=self.schema, keys=keys)
+
+        # Reference the symlink farm instead of building it for every session
+        template_path = self.template_dir()
+        for key in self.template_keys:
+            destination = os.path.join(path, key)
+            if os.path.islink(destination):
+                os.unlink(destination)
+            os.symlink(os.path.join(template_path, key), destination)
+
+        # Precompile the types for the runtime and emulator, see TypeCache
+        type_cache = TypeCache.for_conf_dirs(self['conf-dirs'])
+        type_cache.compile(self['conf']['type'])
+        type_cache.save(os.path.join(path, 'type-cache.json'))
 
         targets_base_path = os.path.join(path, 'targets')
         if not os.path.isdir(targets_base_path):
@@ -148,6 +164,36 @@ class Session(dict):
             target_path = os.path.join(targets_base_path, target.identifier)
             target.to_dir(target_path)
 
+    def template_dir(self):
+        """Return the directory holding the bin and conf directories of this
+        session, creating it if needed.
+
+        The directory is named after a hash of their content, the symlinks
+        to the emulator and the entries of the conf dirs, so it is built
+        once and then shared by all sessions using the same conf dirs.
+        """
+        data = json.dumps([self[key] for key in self.template_keys], sort_keys=True)
+        digest = hashlib.sha1(data.encode()).hexdigest()
+        path = os.path.join(cache_dir(), 'session', digest)
+        if os.path.isdir(path):
+            return path
+        base_path = os.path.dirname(path)
+        os.makedirs(base_path, exist_ok=True)
+        tmp_path = tempfile.mkdtemp(prefix='.tmp-', dir=base_path)
+        try:
+            cconfig.to_dir(tmp_path, self, schema=self.schema, keys=list(self.template_keys))
+            try:
+                os.rename(tmp_path, path)
+            except OSError:
+                # another session created it in the meantime
+                if not os.path.isdir(path):
+                    raise
+        finally:
+            if os.path.exists(tmp_path):
+                shutil.rmtree(tmp_path)
+        log.debug('created session template: %s', path)
+        return path
+
     def __init__(self, targets=None, exec_path=None, manifest=None, tags=None):
         super().__init__(cconfig.from_schema(self.schema))
         self['session-id'] = time.strftime('%Y-%m-%d-%H:%M:%S-{0}-{1}'.format(
@@ -161,6 +207,20 @@ class Session(dict):
         if tags is not None:
             self['tags'] = tags
 
+    @property
+    def emulator_path(self):
+        """Absolute path to the executable that is linked to all types.
+
+        Prefers the lightweight cdng-emulator next to our own executable and
+        falls back to our own executable which also handles being called as a
+        type.
+        """
+        exec_path = os.path.abspath(self['exec-path'])
+        emulator_path = os.path.join(os.path.dirname(exec_path), 'cdng-emulator')
+        if os.access(emulator_path, os.X_OK):
+            return emulator_path
+        return exec_path
+
     def add_conf_dir(self, conf_dir):
         """Add a conf dir to this session.
 
@@ -183,7 +243,7 @@ class Session(dict):
                 self['conf'][sub_dir][entry] = source
 
         # Link emulator to types
-        source = os.path.abspath(self['exec-path'])
+        source = self.emulator_path
         for _type_name in self['conf']['type'].keys():
             self['bin'][_type_name] = source
 
@@ -21,7 +21,7 @@
 
 import os
 import tempfile
-import urllib
+import urllib.parse
 import time
 import base64
 import logging
@@ -141,6 +141,13 @@ class Target(dict):
         else:
             return 'anonymous'
 
+    @property
+    def options(self):
+        """Return the options given in the query part of the target url as
+        a dictionary.
+        """
+        return dict(urllib.parse.parse_qsl(self['target']['query'] or ''))
+
     @property
     def transports(self):
         if self['target']['scheme']:
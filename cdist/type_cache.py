@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+#
+# 2015 Steven Armstrong (steven-cdist at armstrong.cc)
+#
+# This file is part of cdist.
+#
+# cdist is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cdist is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cdist. If not, see <http://www.gnu.org/licenses/>.
+#
+#
+
+
+import os
+import hashlib
+import logging
+log = logging.getLogger(__name__)
+
+from .core import CdistType
+from .cache import cache_dir, JsonCache
+
+
+class TypeCache(JsonCache):
+    """Precompiled metadata of all the types of a session.
+
+    Parsing a type directory means reading a handful of small files, and
+    every process emulating a type used to do that again. Instead the types
+    are compiled into a single json file when the session is created and
+    loaded from there.
+
+    An entry is only recompiled if the mtimes of the type's directory or
+    any of the files and directories which define its metadata changed.
+
+    Usage:
+
+    cache = TypeCache.for_conf_dirs(session['conf-dirs'])
+    cache.compile(session['conf']['type'])
+    cache.save(os.path.join(local_session_dir, 'type-cache.json'))
+
+    cache = TypeCache(os.path.join(local_session_dir, 'type-cache.json'))
+    _type = cache.get('__file')
+    """
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.compiled = 0
+
+    @classmethod
+    def for_conf_dirs(cls, conf_dirs):
+        digest = hashlib.sha1('\0'.join(conf_dirs).encode()).hexdigest()
+        path = os.path.join(cache_dir(), 'type', digest + '.json')
+        return cls(path)
+
+    def save(self, path=None):
+        """Save the cache to its own path and, if given, to path.
+        """
+        for _path in filter(None, (self.path, path)):
+            self.write(_path)
+
+    @staticmethod
+    def signature(type_path):
+        """Return the mtimes of everything that defines the metadata of the
+        type in the given directory.
+        """
+        mtimes = []
+        for path in (type_path, os.path.join(type_path, 'parameter'),
+                os.path.join(type_path, 'parameter', 'default')):
+            try:
+                with os.scandir(path) as entries:
+                    mtimes.append(os.stat(path).st_mtime_ns)
+                    for entry in entries:
+                        mtimes.append(entry.stat().st_mtime_ns)
+            except (FileNotFoundError, NotADirectoryError):
+                mtimes.append(None)
+        return mtimes
+
+    def compile(self, types):
+        """Compile the given types, a mapping of type name to type directory,
+        whose entries are missing or out of date.
+
+        Entries for types which no longer exist are dropped.
+        """
+        entries = self.load()
+        for name in set(entries) - set(types):
+            del entries[name]
+        for name, type_path in types.items():
+            if not os.path.isdir(type_path):
+                continue
+            signature = self.signature(type_path)
+            entry = entries.get(name)
+            if entry is not None and entry['signature'] == signature:
+                continue
+            _type = CdistType.from_dir(type_path, name=name)
+            entries[name] = {
+                'signature': signature,
+                'type': _type.to_data(),
+                'parameter-specs': _type.parameter_specs,
+            }
+            self.compiled += 1
+        log.debug('compiled %d of %d types', self.compiled, len(entries))
+
+    def get(self, name):
+        """Return the named type or None if it is not in the cache.
+        """
+        entry = self.load().get(name)
+        if entry is None:
+            return None
+        return CdistType.from_data(name, entry['type'], entry['parameter-specs'])
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+#
+# 2015 Steven Armstrong (steven-cdist at armstrong.cc)
+#
+# This file is part of cdist.
+#
+# cdist is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cdist is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cdist. If not, see <http://www.gnu.org/licenses/>.
+#
+#
+
+
+class delimited_string_to_set(object):
+    """A click option callback that flattens a list of delimiter seperated
+    strings into one list of options.
+
+    Usage:
+
+    comma_delimited_string_to_set = delimited_string_to_set(',')
+    option = click.Option(('--name',), callback=comma_delimited_string_to_set)
+    """
+    def __init__(self, delimiter):
+        self.delimiter = delimiter
+
+    def __call__(self, ctx, param, value):
+        _list = []
+        for v in value:
+            _list.extend(v.split(self.delimiter))
+        return set(_list)
+
+comma_delimited_string_to_set = delimited_string_to_set(',')
+space_delimited_string_to_set = delimited_string_to_set(' ')
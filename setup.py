@@ -17,7 +17,8 @@ setup(
     ],
     entry_points={
         'console_scripts': [
-            'cdng = cdist.cli:main'
+            'cdng = cdist.cli:main',
+            'cdng-emulator = cdist.emulator_client:main',
         ],
         'cdist.cli.commands': [
             'config = cdist.cli.commands.config:main',
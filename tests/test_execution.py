@@ -0,0 +1,189 @@
+import os
+import io
+import stat
+import shlex
+import asyncio
+import tarfile
+import subprocess
+
+import pytest
+
+from cdist import execution
+
+
+def test_parse_status():
+    output = b'0 0\n1 3\n2 0\n'
+    results = execution.parse_status(output, ['true', 'false', 'true'])
+    assert results[0] is None
+    assert isinstance(results[1], subprocess.CalledProcessError)
+    assert results[1].returncode == 3
+    assert results[1].cmd == 'false'
+    assert results[2] is None
+
+
+def test_parse_status_missing():
+    # the shell died after the first command
+    results = execution.parse_status(b'0 0\n', ['true', 'kill $$', 'true'])
+    assert results[0] is None
+    assert [e.returncode for e in results[1:]] == [255, 255]
+    assert [e.cmd for e in results[1:]] == ['kill $$', 'true']
+
+
+class FakeRuntime(object):
+
+    def __init__(self, loop, base):
+        self.loop = loop
+        self.remote_session_dir = os.path.join(base, 'session')
+        self.target = {'remote-state-dir': os.path.join(base, 'state')}
+
+
+class LocalRemote(execution.Remote):
+    """A remote whose target is the local host, running remote-exec
+    commands with /bin/sh and remembering the data sent to them.
+    """
+
+    def __init__(self, loop, base):
+        self.runtime = FakeRuntime(loop, base)
+        self.sent = []
+
+    async def check_output(self, command, input=None):
+        if command == ['/bin/sh']:
+            args = command
+        else:
+            # remote-exec gets the code quoted as a single word
+            args = ['/bin/sh', '-c', shlex.split(command[0])[0]]
+        self.sent.append(input)
+        process = await asyncio.create_subprocess_exec(*args,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        output, _ = await process.communicate(input)
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, command, output=output)
+        return output
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+def test_filesystem_batch_status_per_operation(loop, tmpdir):
+    remote = LocalRemote(loop, str(tmpdir))
+    batch = execution.RemoteFilesystemBatch(remote)
+    path = str(tmpdir.join('a', 'b'))
+    missing = str(tmpdir.join('missing'))
+
+    async def run():
+        return await asyncio.gather(
+            batch.submit(('mkdir', path)),
+            batch.submit(('chmod', '0700', missing)),
+            batch.submit(('chmod', '0700', path)),
+            return_exceptions=True)
+
+    results = loop.run_until_complete(run())
+    # all operations ran in one script
+    assert len(remote.sent) == 1
+    assert results[0] is None
+    assert isinstance(results[1], subprocess.CalledProcessError)
+    assert results[1].cmd == 'chmod 0700 %s' % shlex.quote(missing)
+    assert results[2] is None
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o700
+
+
+def make_source(path, files):
+    os.makedirs(path, exist_ok=True)
+    for name, content in files.items():
+        file_path = os.path.join(path, name)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, 'w') as fd:
+            fd.write(content)
+
+
+def read_tree(path):
+    tree = {}
+    for root, dirnames, filenames in os.walk(path, followlinks=True):
+        for name in filenames:
+            file_path = os.path.join(root, name)
+            with open(file_path) as fd:
+                tree[os.path.relpath(file_path, path)] = fd.read()
+    return tree
+
+
+def sent_members(data):
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        return sorted(os.path.basename(name) for name in tar.getnames())
+
+
+def test_sync(loop, tmpdir):
+    source = str(tmpdir.join('source'))
+    make_source(source, {'cpu': 'echo cpu', 'sub/memory': 'echo memory'})
+    remote = LocalRemote(loop, str(tmpdir.join('target')))
+    destination = os.path.join(remote.runtime.remote_session_dir, 'conf', 'explorer')
+
+    loop.run_until_complete(remote.sync(source, destination))
+
+    content = os.path.join(remote.state_dir, 'cache', 'content')
+    assert os.path.islink(destination)
+    assert os.path.dirname(os.readlink(destination)) == content
+    tree = read_tree(destination)
+    assert tree.pop('.cdist-manifest')
+    assert tree == read_tree(source)
+
+
+def test_sync_up_to_date(loop, tmpdir):
+    source = str(tmpdir.join('source'))
+    make_source(source, {'cpu': 'echo cpu'})
+    remote = LocalRemote(loop, str(tmpdir.join('target')))
+    destination = os.path.join(remote.runtime.remote_session_dir, 'conf', 'explorer')
+
+    loop.run_until_complete(remote.sync(source, destination))
+    first = os.readlink(destination)
+    del remote.sent[:]
+    loop.run_until_complete(remote.sync(source, destination))
+
+    assert os.readlink(destination) == first
+    assert not any(remote.sent)
+
+
+def test_sync_sends_changes_only(loop, tmpdir):
+    source = str(tmpdir.join('source'))
+    make_source(source, {'cpu': 'echo cpu', 'memory': 'echo memory', 'os': 'echo os'})
+    remote = LocalRemote(loop, str(tmpdir.join('target')))
+    destination = os.path.join(remote.runtime.remote_session_dir, 'conf', 'explorer')
+
+    loop.run_until_complete(remote.sync(source, destination))
+    first = os.readlink(destination)
+    first_tree = read_tree(first)
+    make_source(source, {'cpu': 'echo changed', 'disks': 'echo disks'})
+    os.remove(os.path.join(source, 'os'))
+    del remote.sent[:]
+    loop.run_until_complete(remote.sync(source, destination))
+
+    data = [input for input in remote.sent if input]
+    assert len(data) == 1
+    assert sent_members(data[0]) == ['cpu', 'disks']
+    tree = read_tree(destination)
+    del tree['.cdist-manifest']
+    assert tree == read_tree(source)
+    # sessions still using the previous content are not affected
+    assert os.readlink(destination) != first
+    assert read_tree(first) == first_tree
+
+
+def test_sync_concurrent(loop, tmpdir):
+    source = str(tmpdir.join('source'))
+    make_source(source, {'cpu': 'echo cpu'})
+    remote = LocalRemote(loop, str(tmpdir.join('target')))
+    destinations = [os.path.join(remote.runtime.remote_session_dir, session, 'explorer')
+        for session in ('a', 'b', 'c')]
+
+    async def run():
+        await asyncio.gather(*[remote.sync(source, destination) for destination in destinations])
+
+    loop.run_until_complete(run())
+
+    targets = set(os.readlink(destination) for destination in destinations)
+    assert len(targets) == 1
+    content = os.path.join(remote.state_dir, 'cache', 'content')
+    assert os.listdir(content) == [os.path.basename(targets.pop())]
@@ -0,0 +1,115 @@
+import os
+import asyncio
+import logging
+
+import pytest
+
+pytest.importorskip('cconfig')
+
+from cdist import runtime
+from cdist.explorer_cache import ExplorerCache
+
+
+class FakeObject(dict):
+
+    def __init__(self, type_name, object_id, explorers):
+        super().__init__()
+        self.name = '%s/%s' % (type_name, object_id)
+        self['type'] = type_name
+        self['object-id'] = object_id
+        self['parameter'] = {'state': 'present'}
+        self['explorer'] = {name: None for name in explorers}
+
+
+class RecordingRuntime(runtime.Runtime):
+    """A runtime which records what it would transfer to and run on the
+    target instead of doing it.
+    """
+    path = None
+
+    def __init__(self, loop, tmpdir, cache):
+        self.loop = loop
+        self.log = logging.getLogger(__name__)
+        self.explorer_cache = cache
+        self.explorer_batch = None
+        self.target = {'explorer': {}}
+        self.path = {
+            'local': {'explorer': str(tmpdir.join('explorer'))},
+            'remote': {'explorer': '/remote/explorer'},
+        }
+        self.tmpdir = tmpdir
+        self.calls = []
+
+    def get_type_path(self, type_name, context, component):
+        return str(self.tmpdir.join('type', type_name, component))
+
+    async def record(self, name, result=None):
+        self.calls.append(name)
+        return result
+
+    def transfer_global_explorers(self):
+        return self.record('transfer_global_explorers')
+
+    def transfer_object_parameters(self, cdist_object):
+        return self.record('transfer_object_parameters')
+
+    def run_global_explorer(self, name):
+        return self.record('run_global_explorer', 'fresh')
+
+    def sync_target(self, *keys):
+        return self.record('sync_target')
+
+    def sync_object(self, cdist_object, *keys):
+        return self.record('sync_object')
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture
+def cache(tmpdir):
+    for script in ('explorer/memory', 'type/__file/explorer/stat'):
+        path = tmpdir.join(script)
+        path.ensure()
+        path.write('#!/bin/sh\n')
+    return ExplorerCache(str(tmpdir.join('cache.json')), ttl=3600, ttls={'__file/stat': 3600})
+
+
+def test_global_explorers_cached(loop, tmpdir, cache):
+    _runtime = RecordingRuntime(loop, tmpdir, cache)
+    cache.set('memory', os.path.join(_runtime.path['local']['explorer'], 'memory'), 'cached')
+
+    loop.run_until_complete(_runtime.run_global_explorers(['memory']))
+
+    assert _runtime.target['explorer'] == {'memory': 'cached'}
+    assert 'run_global_explorer' not in _runtime.calls
+    # type explorers may still call them
+    assert 'transfer_global_explorers' in _runtime.calls
+
+
+def test_global_explorers_missing(loop, tmpdir, cache):
+    _runtime = RecordingRuntime(loop, tmpdir, cache)
+
+    loop.run_until_complete(_runtime.run_global_explorers(['memory']))
+
+    assert _runtime.target['explorer'] == {'memory': 'fresh'}
+    assert _runtime.calls.count('run_global_explorer') == 1
+    assert cache.get('memory', os.path.join(_runtime.path['local']['explorer'], 'memory')) == 'fresh'
+
+
+def test_type_explorers_cached(loop, tmpdir, cache):
+    _runtime = RecordingRuntime(loop, tmpdir, cache)
+    cdist_object = FakeObject('__file', 'etc/motd', ['stat'])
+    explorer, script, object_name, parameters = _runtime.type_explorer_cache_key(cdist_object, 'stat')
+    cache.set(explorer, script, 'cached', object_name, parameters)
+
+    loop.run_until_complete(_runtime.run_type_explorers(cdist_object))
+
+    assert cdist_object['explorer'] == {'stat': 'cached'}
+    # code-remote may still read the parameters
+    assert 'transfer_object_parameters' in _runtime.calls
+    assert 'sync_object' in _runtime.calls